@@ -266,6 +266,8 @@ class CityModel(mesa.Model):
         super().__init__(seed=seed)
         self.num_cars = cars
         self.cars_list = []
+        # Car number (1, 2, ...; unique_id is its negative) -> Car
+        self.cars_by_id = {}
         self.grid = mesa.space.MultiGrid(24, 24, False)
         self.roundabout_cells = [(13, 13), (14, 13), (13, 14), (14, 14)]
         self.initialize_semaphores()
@@ -288,10 +290,16 @@ class CityModel(mesa.Model):
 
         car = Car(unique_id=-(i+1), start_parking=start_parking, target_parking=target_parking, model=self)
         self.cars_list.append(car)
+        self.cars_by_id[i + 1] = car
         self.grid.place_agent(car, start_parking)
         print(f"Car {i + 1}: Start {start_parking}, Target {target_parking}")
 
 
+    def get_car(self, car_id):
+        """Car by its number (the positive counterpart of unique_id), or None."""
+        return self.cars_by_id.get(car_id)
+
+
     def initialize_semaphores(self):
         self.semaphores = {}
         #Define semaphores coordinates
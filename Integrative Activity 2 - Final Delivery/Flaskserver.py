@@ -1,21 +1,101 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+import numpy as np
 from Final import CityModel
 
 city_model = CityModel(cars=17)
 
 app = Flask(__name__)
 
+STATE_CODES = {"idle": 0, "moving": 1, "arrived": 2}
+
+
+def car_number(car):
+    """Public car number, as clients ask for it: unique_id is its negative."""
+    return -car.unique_id
+
+
+def requested_ids():
+    """Car numbers from ?ids=1,2,3 or a JSON body {"ids": [1, 2, 3]}, or None if malformed."""
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return None
+        car_ids = body.get("ids", [])
+    else:
+        ids = request.args.get("ids", "")
+        try:
+            car_ids = [int(car_id) for car_id in ids.split(",")] if ids.strip() else []
+        except ValueError:
+            return None
+    # bool is an int too, but {"ids": [true]} is no car number
+    if not isinstance(car_ids, list) or not all(type(car_id) is int for car_id in car_ids):
+        return None
+    return car_ids
+
+
+class ChangeTracker:
+    """Remembers, per car, the last tick at which its position or state changed."""
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = np.array([car_number(car) for car in model.cars_list], dtype=np.int64)
+        self.x, self.y, self.state = self.read()
+        self.changed_at = np.full(len(self.ids), model.steps, dtype=np.int64)
+
+    def read(self):
+        cars = self.model.cars_list
+        x = np.fromiter((car.pos[0] for car in cars), dtype=np.int64, count=len(cars))
+        y = np.fromiter((car.pos[1] for car in cars), dtype=np.int64, count=len(cars))
+        state = np.fromiter((STATE_CODES[car.state] for car in cars), dtype=np.int64, count=len(cars))
+        return x, y, state
+
+    def record(self):
+        x, y, state = self.read()
+        changed = (x != self.x) | (y != self.y) | (state != self.state)
+        self.changed_at[changed] = self.model.steps
+        self.x, self.y, self.state = x, y, state
+
+    def since(self, tick):
+        """Rows [car_id, x, y, state] of the cars that changed after tick."""
+        changed = self.changed_at > tick
+        rows = np.stack([self.ids[changed], self.x[changed], self.y[changed], self.state[changed]], axis=1)
+        return rows.tolist()
+
+
+changes = ChangeTracker(city_model)
+
 @app.route("/car_position/<int:car_id>", methods=["GET"])
 def get_car_position(car_id):
-    car = next((car for car in city_model.cars_list if car.unique_id == -car_id), None)
+    car = city_model.get_car(car_id)
     if not car:
         return jsonify({"error": "Car not found"}), 404
 
     return jsonify({
-        "car_id": car.unique_id,
+        "car_id": car_id,
         "current_position": car.pos
     })
 
+@app.route("/car_positions", methods=["GET", "POST"])
+def get_car_positions():
+    # Many cars per request: ?ids=1,2,3 or a JSON body {"ids": [1, 2, 3]}
+    car_ids = requested_ids()
+    if car_ids is None:
+        return jsonify({"error": "ids must be a list of car numbers"}), 400
+
+    cars = []
+    missing = []
+    for car_id in car_ids:
+        car = city_model.get_car(car_id)
+        if car:
+            cars.append({"car_id": car_id, "current_position": car.pos})
+        else:
+            missing.append(car_id)
+
+    return jsonify({
+        "cars": cars,
+        "missing": missing
+    })
+
 @app.route("/")
 def index():
     return jsonify({"Message": "Hello from the Team 7"})
@@ -26,7 +106,7 @@ def start_pos():
     car_positions = []
     for car in city_model.cars_list:
         car_positions.append({
-            "car_id": car.unique_id,
+            "car_id": car_number(car),
             "start_parking": car.start_parking
         })
     
@@ -43,21 +123,20 @@ def positions():
     for car in city_model.cars_list:
         # Store the old position before calling city_model.step()
         old_position = {"x": car.pos[0], "y": car.pos[1]}
-        print(f"Old position of car {car.unique_id}: {old_position}")
+        print(f"Old position of car {car_number(car)}: {old_position}")
         
         # Append the car's id and its old position to the car_positions list
         car_positions.append({
-            "car_id": car.unique_id,
+            "car_id": car_number(car),
             "old_position": old_position
         })
     # Update the positions by running the step function for all cars
     city_model.step()
+    changes.record()
 
-    for car in city_model.cars_list:
-        for car_pos in car_positions:
-            if car_pos["car_id"] == car.unique_id:
-                new_position = {"x": car.pos[0], "y": car.pos[1]}
-                car_pos["new_position"] = new_position
+    # cars_list keeps its order, so entries line up with car_positions
+    for car, car_pos in zip(city_model.cars_list, car_positions):
+        car_pos["new_position"] = {"x": car.pos[0], "y": car.pos[1]}
     
     # Return the updated positions of all cars
     return jsonify({
@@ -65,5 +144,21 @@ def positions():
         "car_positions": car_positions
     })
 
+@app.route("/positions/delta", methods=["GET", "POST"])
+def positions_delta():
+    # Like /positions this advances the model one tick, but only returns the cars whose
+    # position or state changed after the client's last seen tick (?since=<tick>).
+    # Without since, the changes of this tick are returned; since=-1 returns every car.
+    since = request.args.get("since", default=city_model.steps, type=int)
+    city_model.step()
+    changes.record()
+
+    return jsonify({
+        "tick": city_model.steps,
+        "fields": ["car_id", "x", "y", "state"],
+        "states": list(STATE_CODES),
+        "cars": changes.since(since)
+    })
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
@@ -1,41 +1,87 @@
 from ast import Return
+import bisect
+from collections import deque
+import itertools
 import mesa
+from mesa.agent import AgentSet
 import numpy as np
+
+from events import NullSink, TRACE, DEBUG, INFO
+from profiling import PhaseProfiler, profiled
+from city_map import default_map
+
+# Lane headings, stored as bit flags in CityModel.lane_directions
+DOWN = 1    # x increases
+UP = 2      # x decreases
+LEFT = 4    # y decreases
+RIGHT = 8   # y increases
+
+HEADING_BITS = {(1, 0): DOWN, (-1, 0): UP, (0, -1): LEFT, (0, 1): RIGHT}
+
+# Order of MultiGrid.get_neighborhood(moore=False): up, left, right, down
+NEIGHBOR_OFFSETS = np.array([(-1, 0), (0, -1), (0, 1), (1, 0)])
+NEIGHBOR_BITS = np.array([UP, LEFT, RIGHT, DOWN], dtype=np.uint8)
+
+# Integer codes of states, headings and lights (batch engine arrays and binary snapshots).
+# The heading code of a step through NEIGHBOR_OFFSETS[k] is k + 1.
+STATE_NAMES = ("idle", "moving", "arrived")
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+DIRECTION_NAMES = (None, "up", "left", "right", "down")
+# Spawn mode keeps at most this share of the road cells' worth of cars in transit; with one car
+# per cell a fuller grid can lock up for good
+SPAWN_ROAD_SHARE = 0.25
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTION_NAMES)}
+LIGHT_NAMES = ("yellow", "green", "red")
+LIGHT_CODES = {name: code for code, name in enumerate(LIGHT_NAMES)}
+
+# Binary snapshot layout (little-endian, packed): header, semaphore records, car records
+SNAPSHOT_MAGIC = b"CITY"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = np.dtype([("magic", "S4"), ("version", "<u2"), ("tick", "<u4"), ("cars", "<u4"), ("semaphores", "<u4")])
+SEMAPHORE_RECORD = np.dtype([("id", "<i4"), ("light", "u1")])
+CAR_RECORD = np.dtype([("id", "<i4"), ("x", "<i2"), ("y", "<i2"), ("heading", "u1"), ("state", "u1")])
+
+
+def parse_snapshot(buffer):
+    """(tick, semaphore records, car records) of a snapshot_buffer() layout, as views into buffer."""
+    storage = np.frombuffer(buffer, dtype=np.uint8)
+    header = storage[:SNAPSHOT_HEADER.itemsize].view(SNAPSHOT_HEADER)[0]
+    cars_offset = SNAPSHOT_HEADER.itemsize + int(header["semaphores"]) * SEMAPHORE_RECORD.itemsize
+    semaphores = storage[SNAPSHOT_HEADER.itemsize:cars_offset].view(SEMAPHORE_RECORD)
+    cars = storage[cars_offset:cars_offset + int(header["cars"]) * CAR_RECORD.itemsize].view(CAR_RECORD)
+    return int(header["tick"]), semaphores, cars
+
+
 class Car(mesa.Agent):
     def __init__(self, unique_id, start_parking, target_parking, model):
         super().__init__(model)
         self.unique_id = unique_id
         self.start_parking = start_parking
         self.target_parking = target_parking
+        self._state = None
         self.state = "idle"
         self.direction = None
         self.last_pos = None
         self.exited_parking = False
+        # Ticks at which the car entered the grid and reached its target (None until then)
+        self.departure_step = model.steps
+        self.arrival_step = None
 
-        # Movement restrictions
-        self.y_change_down = [0, 1, 12, 13] + self.generate_range(15, 22, 6, 7)
-        self.y_change_up = [14, 15, 22, 23] + self.generate_range(22, 15, 18, 19) + self.generate_range(12, 1, 6, 7)
-        self.x_change_left = [0, 1, 12, 13] + self.generate_range(6, 7, 22, 15) + self.generate_range(5, 6, 12, 7) + self.generate_range(18, 19, 6, 1)
-        self.x_change_right = [14, 15, 22, 23] + self.generate_range(18, 19, 7, 12)
 
+    @property
+    def state(self):
+        return self._state
 
-    def generate_range(self, start_x, end_x, start_y, end_y):
-        cells = []
-        if start_x <= end_x:
-            x_range = range(start_x, end_x + 1)
-        else:
-            x_range = range(start_x, end_x - 1, -1)
-
-        if start_y <= end_y:
-            y_range = range(start_y, end_y + 1)
-        else:
-            y_range = range(start_y, end_y - 1, -1)
-
-        for x in x_range:
-            for y in y_range:
-                cells.append((x, y))
-
-        return cells
+    @state.setter
+    def state(self, state):
+        # Keep CityModel.state_counts in step with every transition
+        previous = self._state
+        if state != previous:
+            counts = self.model.state_counts
+            if previous is not None:
+                counts[previous] -= 1
+            counts[state] += 1
+            self._state = state
 
 
     def step(self):
@@ -47,78 +93,133 @@ class Car(mesa.Agent):
           else:
             self.state = "arrived"
             self.direction = None
-            print(f"Car {self.unique_id} has reached its target parking at {self.target_parking}. No more moves.")
+            self.arrival_step = self.model.steps
+            if self.model.spawn:
+                # Parked inside the lot: free the cell for the next car heading here
+                self.model.occupancy[self.pos] -= 1
+            # Parked cars are no longer stepped until set_target gives them somewhere to go
+            self.model.active_cars.discard(self)
+            events = self.model.events
+            if events.level <= INFO:
+                events.emit(INFO, "car_arrived", step=self.model.steps, car=self.unique_id, pos=self.target_parking)
+
+
+    def set_target(self, target_parking):
+        """Send the car to a new parking lot; a parked car leaves its lot and is stepped again."""
+        self.target_parking = target_parking
+        if self.state != "arrived":
+            return
+        self.state = "idle"
+        self.exited_parking = False
+        self.last_pos = None
+        self.departure_step = self.model.steps
+        self.arrival_step = None
+        if self.model.spawn:
+            self.model.occupancy[self.pos] += 1
+        self.model.active_cars.add(self)
 
 
+    @profiled("car.exit_parking")
     def exit_parking(self):
         possible_steps = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False)
 
-        valid_steps = [
-            step for step in possible_steps
-            if self.model.grid.properties["city_objects"].data[step] == 0
-        ]
+        # Plain road cells without a car
+        city_objects = self.model.grid.properties["city_objects"].data
+        occupancy = self.model.occupancy
+        valid_steps = [step for step in possible_steps if city_objects[step] == 0 and not occupancy[step]]
 
         if valid_steps:
-            new_position = self.random.choice(valid_steps)
-            self.model.grid.properties["city_objects"].set_cell(self.pos, 0)
-            self.model.grid.move_agent(self, new_position)
-            self.model.grid.properties["city_objects"].set_cell(new_position, -1)
+            hop = self.next_route_hop()
+            new_position = hop if hop in valid_steps else self.random.choice(valid_steps)
+            self.relocate(new_position)
             self.exited_parking = True
             self.state = "moving"
-            print(f"Car {self.unique_id} exited parking to {new_position}.")
+            events = self.model.events
+            if events.level <= DEBUG:
+                events.emit(DEBUG, "car_exited_parking", step=self.model.steps, car=self.unique_id, to=new_position)
         else:
-            print(f"Car {self.unique_id} cannot exit parking from {self.pos}.")
+            events = self.model.events
+            if events.level <= DEBUG:
+                events.emit(DEBUG, "car_blocked_in_parking", step=self.model.steps, car=self.unique_id, pos=self.pos)
 
 
+    @profiled("car.move")
     def move(self):
-        print(f"Car {self.unique_id} at position {self.pos} moving in direction {self.direction}")
-
+        events = self.model.events
         adjacent_cells = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False)
 
-        possible_adjacent_cells = [
-            step for step in adjacent_cells
-            if self.model.grid.properties["city_objects"].data[step] == 0
-        ]
-
-        print(f"Adjacent cells: {adjacent_cells}. Possible cells: {possible_adjacent_cells}")
+        occupancy = self.model.occupancy
+        possible_adjacent_cells = [step for step in adjacent_cells if not occupancy[step]]
 
+        if events.level <= TRACE:
+            events.emit(TRACE, "car_neighborhood", step=self.model.steps, car=self.unique_id, pos=self.pos,
+                        direction=self.direction, adjacent=adjacent_cells, possible=possible_adjacent_cells)
 
-
-        if self.target_parking in possible_adjacent_cells:
-            print(f"Car {self.unique_id} is adjacent to target parking. Moving directly to {self.target_parking}.")
-            self.model.grid.properties["city_objects"].set_cell(self.pos, 0)
+        # In spawn mode lots work as garages: cars park there even while a spawned car waits to leave
+        if self.target_parking in possible_adjacent_cells or (self.model.spawn and self.target_parking in adjacent_cells):
             self.last_pos = self.pos
-            self.model.grid.move_agent(self, self.target_parking)
-            self.model.grid.properties["city_objects"].set_cell(self.target_parking, -1)
-
+            self.relocate(self.target_parking)
             self.state = "moving"
-            print(f"Car {self.unique_id} moved to target parking at {self.target_parking}.")
             new_position = self.target_parking
+            if events.level <= DEBUG:
+                events.emit(DEBUG, "car_moved", step=self.model.steps, car=self.unique_id, to=new_position, target=True)
         else:
-            possible_steps = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False)
-            valid_steps = [step for step in possible_steps if self.is_valid_step(step)]
+            valid_steps = [step for step in adjacent_cells if self.is_valid_step(step)]
+            hop = self.next_route_hop()
+
+            if hop is not None and hop not in valid_steps and (
+                    hop == self.target_parking or self.model.grid.properties["city_objects"].data[hop] == 19):
+                # Wait for the light or the occupied target instead of leaving the route
+                if events.level <= DEBUG:
+                    events.emit(DEBUG, "car_waiting", step=self.model.steps, car=self.unique_id, pos=self.pos, at=hop)
+                self.state = "idle"
+                return
 
             if not valid_steps:
-                print(f"No valid steps for car {self.unique_id} at position {self.pos}.")
+                if events.level <= DEBUG:
+                    events.emit(DEBUG, "car_stuck", step=self.model.steps, car=self.unique_id, pos=self.pos)
                 self.state = "idle"
                 return
 
-            new_position = self.random.choice(valid_steps)
+            new_position = hop if hop in valid_steps else self.random.choice(valid_steps)
             self.update_direction(new_position)
 
-            self.model.grid.properties["city_objects"].set_cell(self.pos, 0)
             self.last_pos = self.pos
-            self.model.grid.move_agent(self, new_position)
-            self.model.grid.properties["city_objects"].set_cell(new_position, -1)
+            self.relocate(new_position)
             self.state = "moving"
-            print(f"Car {self.unique_id} moved to {new_position}")
+            if events.level <= DEBUG:
+                events.emit(DEBUG, "car_moved", step=self.model.steps, car=self.unique_id, to=new_position,
+                            direction=self.direction)
 
-        #Enter the range for being detected by the semaphore
-        for semaphore in self.model.semaphores.values():
-            if new_position in semaphore.range_cells:
-                semaphore.manage_light_state()
 
 
+    def relocate(self, new_position):
+        """Move the car, updating the occupancy counts and the semaphore range sets.
+
+        Semaphores whose range the car leaves or enters are marked for the controller phase
+        of CityModel.step instead of being re-evaluated right away.
+        """
+        occupancy = self.model.occupancy
+        semaphore_index = self.model.semaphore_index
+        dirty_semaphores = self.model.dirty_semaphores
+        for semaphore in semaphore_index.get(self.pos, ()):
+            semaphore.cars_in_range.discard(self.unique_id)
+            dirty_semaphores.add(semaphore.controller)
+        occupancy[self.pos] -= 1
+        self.model.grid.move_agent(self, new_position)
+        occupancy[new_position] += 1
+        for semaphore in semaphore_index.get(new_position, ()):
+            semaphore.cars_in_range.add(self.unique_id)
+            dirty_semaphores.add(semaphore.controller)
+
+
+    def next_route_hop(self):
+        """Next cell of the shortest route to the target, or None without routing or route."""
+        routes = self.model.routes
+        if routes is None:
+            return None
+        return routes.next_hop(self.pos, self.target_parking)
+
 
     def can_move(self):
         current_position = self.pos
@@ -136,12 +237,16 @@ class Car(mesa.Agent):
         return True
 
 
+    @profiled("car.is_valid_step")
     def is_valid_step(self, step):
         current_x, current_y = self.pos
         step_x, step_y = step
 
         if self.last_pos and step == self.last_pos:
             return False
+        # One car per road cell: occupancy is the collision check
+        if self.model.occupancy[step]:
+            return False
 
         cell_value = self.model.grid.properties["city_objects"].data[step]
         if cell_value == 19:
@@ -151,42 +256,9 @@ class Car(mesa.Agent):
             else:
                 return False
 
-        # Restricciones para columnas completas (y_change_down y y_change_up)
-        if step_y in self.y_change_down[:4]:
-            if step_x > current_x:
-                return True
-
-        if step_y in self.y_change_up[:4]:
-            if step_x < current_x:
-                return True
-
-        # Restricciones para filas completas (x_change_left y x_change_right)
-        if step_x in self.x_change_left[:4]:
-            if step_y < current_y:
-                return True
-
-        if step_x in self.x_change_right[:4]:
-            if step_y > current_y:
-                return True
-
-        # Restricciones para regiones específicas (rectángulos)
-        if (step_x, step_y) in self.y_change_down[4:]:
-            if step_x > current_x:
-                return True
-
-        if (step_x, step_y) in self.y_change_up[4:]:
-            if step_x < current_x:
-                return True
-
-        if (step_x, step_y) in self.x_change_left[4:]:
-            if step_y < current_y:
-                return True
-
-        if (step_x, step_y) in self.x_change_right[4:]:
-            if step_y > current_y:
-                return True
-
-        return False
+        # Lane restrictions are precomputed per cell in CityModel.lane_directions
+        heading = HEADING_BITS[(step_x - current_x, step_y - current_y)]
+        return bool(self.model.lane_directions[step_x, step_y] & heading)
 
 
     def update_direction(self, new_position):
@@ -214,6 +286,10 @@ class SemaphoreAgent(mesa.Agent):
         self.step_counter = 0
         self.waiting_cars = set()
         self.range_cells = range_cells if range_cells else []
+        # Ids of the cars inside range_cells, kept up to date by Car.relocate and CityModel.place_car
+        self.cars_in_range = set()
+        # Member of the pair that evaluates it in CityModel.update_semaphores (the higher id)
+        self.controller = self
 
     def update_state(self):
         for position in self.positions:
@@ -226,61 +302,161 @@ class SemaphoreAgent(mesa.Agent):
             self.model.grid.properties["city_objects"].set_cell(position, state_value)
 
     def check_car_presence(self):
-        cars_in_range = set()
-        for pos in self.range_cells:
-            for agent in self.model.grid.get_cell_list_contents(pos):
-                if isinstance(agent, Car):
-                    cars_in_range.add(agent.unique_id)
-        return cars_in_range
+        """Ids of the cars in range right now, as a copy: waiting_cars mustn't follow later moves."""
+        return set(self.cars_in_range)
 
 
+    @profiled("semaphore.manage_light_state")
     def manage_light_state(self):
+        """Give green to the side with cars in range; returns whether both sides have cars.
+
+        When both do, the side holding green keeps it for green_duration evaluations (step_counter
+        counts them), then yields, so a busy approach can't starve the other one.
+        """
         cars_in_range = self.check_car_presence()
         self.waiting_cars = cars_in_range
 
         paired_semaphore = self.model.semaphores[self.paired_semaphore]
-
-        # Normal behavior when neither semaphore is green
-        if cars_in_range:
+        paired_semaphore.waiting_cars = paired_semaphore.check_car_presence()
+        self.model.semaphore_evaluations += 1
+
+        contested = bool(cars_in_range and paired_semaphore.waiting_cars)
+        if contested:
+            # Keep the current green until it has lasted green_duration (this side when neither is green)
+            keep = paired_semaphore.light_state != "green"
+            if self.step_counter >= self.green_duration:
+                keep = not keep
+            self.step_counter = 0 if (self.light_state == "green") != keep else self.step_counter + 1
+            self.light_state = "green" if keep else "red"
+            paired_semaphore.light_state = "red" if keep else "green"
+        elif cars_in_range:
             # Turn this semaphore green if there are cars in range
+            self.step_counter = 0
             self.light_state = "green"
             paired_semaphore.light_state = "red"
         elif paired_semaphore.waiting_cars:
             # Turn paired semaphore green if it has cars waiting
+            self.step_counter = 0
             self.light_state = "red"
             paired_semaphore.light_state = "green"
         else:
             # Default to yellow for both if no cars are present at either semaphore
+            self.step_counter = 0
             self.light_state = "yellow"
             paired_semaphore.light_state = "yellow"
 
         self.update_state()
         paired_semaphore.update_state()
+        return contested
+
+
+    @profiled("semaphore.manage_fixed_cycle")
+    def manage_fixed_cycle(self):
+        """Fixed-time policy: green for green_duration ticks, then red for red_duration ticks; the pair does the opposite."""
+        paired_semaphore = self.model.semaphores[self.paired_semaphore]
+        self.waiting_cars = self.check_car_presence()
+        paired_semaphore.waiting_cars = paired_semaphore.check_car_presence()
+        self.model.semaphore_evaluations += 1
+
+        if self.step_counter < self.green_duration:
+            self.light_state = "green"
+            paired_semaphore.light_state = "red"
+        else:
+            self.light_state = "red"
+            paired_semaphore.light_state = "green"
+        self.step_counter = (self.step_counter + 1) % (self.green_duration + self.red_duration)
+
+        self.update_state()
+        paired_semaphore.update_state()
 
 
 
 class CityModel(mesa.Model):
     """A model of a city with some number of cars, semaphores, buildings, parking lots and a roundabout."""
 
-    def __init__(self, cars, seed=None):
+    def __init__(self, cars, seed=None, spawn=False, target_weights=None, events=None, engine="agents", routing=True,
+                 semaphore_policy="actuated", green_duration=5, red_duration=5, profile=False, city_map=None):
         super().__init__(seed=seed)
+        # Per-phase and per-method wall times (profiling.py); None skips the timing
+        self.profiler = None
+        if profile:
+            self.enable_profiling()
+        # "actuated": a pair gives green to the side with cars in range (manage_light_state);
+        # "fixed": every pair cycles on green_duration/red_duration ticks (manage_fixed_cycle)
+        if semaphore_policy not in ("actuated", "fixed"):
+            raise ValueError(f"Unknown semaphore_policy {semaphore_policy!r}, expected 'actuated' or 'fixed'.")
+        self.semaphore_policy = semaphore_policy
+        self.green_duration = green_duration
+        self.red_duration = red_duration
+        # Where simulation events go; the default NullSink drops them without formatting
+        self.events = events if events is not None else NullSink()
         self.num_cars = cars
         self.cars_list = []
+        # Cars on the grid per state ("idle", "moving", "arrived"), maintained by the Car.state setter
+        self.state_counts = dict.fromkeys(STATE_NAMES, 0)
+        # Car number (1, 2, ...; unique_id is its negative) -> Car
+        self.cars_by_id = {}
+        # Spawn mode: cars wait in per-lot/entry queues and enter the grid over time
+        self.spawn = spawn
+        self.target_weights = target_weights
+        self.spawn_queues = {}
+        self.pending_spawns = 0
+        # Cars the agent engine steps each tick; arrived cars leave it (Car.step) and rejoin via Car.set_target
+        self.active_cars = AgentSet([], random=self.random)
         '''buildingprint = mesa.space.PropertyLayer("buildings", 24, 24, np.float64(0), np.float64(0))
         parkingsprint = mesa.space.PropertyLayer("parking_lots", 24, 24, np.float64(0), np.float64(0))
         roundaboutprint = mesa.space.PropertyLayer("roundabout", 24, 24, np.float64(0), np.float64(0))
         semaphoreprint = mesa.space.PropertyLayer("semaphore_pairs", 24, 24, np.float64(0), np.float64(0))'''
-        self.grid = mesa.space.MultiGrid(24, 24, False)
-        self.roundabout_cells = [(13, 13), (14, 13), (13, 14), (14, 14)]
+        # Layout of the city (city_map.py); the default is the original 24x24 map
+        self.city_map = city_map if city_map is not None else default_map()
+        self.grid = mesa.space.MultiGrid(self.city_map.width, self.city_map.height, False)
         self.initialize_city_objects()
+        self.initialize_target_weights()
+        # Cars standing on each cell: claimed in place_car/Car.relocate, released when a car moves
+        # on (or parks, in spawn mode). city_objects keeps the static map and the lights.
+        self.occupancy = np.zeros((self.city_map.width, self.city_map.height), dtype=np.int32)
+        self.initialize_lane_directions()
         self.initialize_semaphores()
+
+        # Cars follow cached shortest routes (routing.py) unless routing=False (random walk).
+        # Bump map_version after changing the map so cached routes are rebuilt.
+        self.map_version = 0
+        self.routes = None
+        if routing:
+            from routing import RouteTable
+            self.routes = RouteTable(self)
         self.initialize_cars()
+        self.update_semaphores()
         self.steps = 0
 
+        # Preallocated on the first snapshot_buffer() call
+        self.snapshot_storage = None
+        # Set by share_state(); other processes read its segment with shared_state.StateReader
+        self.publisher = None
+        # Set by record_replay(); appends every tick to a replay log (replay.py)
+        self.recorder = None
+
+        # engine="batch" steps the whole fleet with NumPy arrays (see batch.py)
+        self.batch = None
+        if engine == "batch":
+            from batch import BatchEngine
+            self.batch = BatchEngine(self)
+        elif engine != "agents":
+            raise ValueError(f"Unknown engine {engine!r}, expected 'agents' or 'batch'.")
+
+    def enable_profiling(self):
+        """Start recording phase and agent method timings in a fresh self.profiler."""
+        self.profiler = PhaseProfiler()
+        return self.profiler
+
     def initialize_cars(self):
-      # Only 17 existing parking lots
-      if self.num_cars > 17:
-          raise ValueError("All parking lots have been assigned to a car. No more spaces.")
+      if self.spawn:
+          self.initialize_spawn_queues()
+          return
+
+      # One car per parking lot
+      if self.num_cars > len(self.parking_lots):
+          raise ValueError("All parking lots have been assigned to a car. No more spaces. Use spawn=True for bigger fleets.")
 
       for i in range(self.num_cars):
         start_parking = self.parking_lots[i % len(self.parking_lots)]
@@ -292,121 +468,330 @@ class CityModel(mesa.Model):
 
         car = Car(unique_id=-(i+1), start_parking=start_parking, target_parking=target_parking, model=self)
         self.cars_list.append(car)
-        self.grid.place_agent(car, start_parking)
-        print(f"Car {i + 1}: Start {start_parking}, Target {target_parking}")
+        self.cars_by_id[i + 1] = car
+        self.place_car(car, start_parking)
+        if self.events.level <= INFO:
+          self.events.emit(INFO, "car_created", car=car.unique_id, start=start_parking, target=target_parking)
+
+
+    def get_car(self, car_id):
+      """Car by its number (the positive counterpart of unique_id), or None if it doesn't exist or hasn't spawned yet."""
+      self.sync_agents()
+      return self.cars_by_id.get(car_id)
+
+
+    def sync_agents(self):
+      """Bring the Car and SemaphoreAgent objects up to the current tick.
+
+      The batch engine only steps its arrays and leaves the agents behind until something
+      reads them; get_car, count_cars, trip_times and checkpoints call this first, and so
+      should any other reader of cars_list or the semaphores. With the agent engine they are
+      always current and this does nothing.
+      """
+      if self.batch is not None:
+          self.batch.sync_agents()
+
+
+    def initialize_spawn_queues(self):
+      """Queue every car at a spawn point (parking lot or road entry); they enter the grid in spawn_cars."""
+      self.entry_points = self.find_entry_points()
+      spawn_points = self.parking_lots + self.entry_points
+      self.spawn_queues = {point: deque() for point in spawn_points}
+
+      for i in range(self.num_cars):
+        start = spawn_points[i % len(spawn_points)]
+        target_parking = self.choose_target(start)
+        self.spawn_queues[start].append((i, target_parking))
+      self.pending_spawns = self.num_cars
+      self.initialize_spawn_capacity()
+
+
+    def initialize_spawn_capacity(self):
+      """Cap the cars in transit at SPAWN_ROAD_SHARE of the road cells; spawn_cars holds the queues back beyond it."""
+      self.spawn_capacity = max(1, int(np.count_nonzero(self.lane_directions) * SPAWN_ROAD_SHARE))
+
+
+    def find_entry_points(self):
+      """Road cells on the border whose lane heading points into the city."""
+      lanes = self.lane_directions
+      city_objects = self.grid.properties["city_objects"].data
+      entering = np.zeros(lanes.shape, dtype=bool)
+      entering[0, :] |= (lanes[0, :] & DOWN) != 0
+      entering[-1, :] |= (lanes[-1, :] & UP) != 0
+      entering[:, 0] |= (lanes[:, 0] & RIGHT) != 0
+      entering[:, -1] |= (lanes[:, -1] & LEFT) != 0
+      xs, ys = np.nonzero(entering & (city_objects == 0))
+      return list(zip(xs.tolist(), ys.tolist()))
+
+
+    def initialize_target_weights(self):
+      """Check target_weights (one non-negative weight per parking lot) and precompute their running sums."""
+      weights = self.target_weights if self.target_weights is not None else [1] * len(self.parking_lots)
+      if len(weights) != len(self.parking_lots):
+          raise ValueError(f"target_weights has {len(weights)} weights for {len(self.parking_lots)} parking lots.")
+      if any(weight < 0 for weight in weights):
+          raise ValueError("target_weights must not be negative.")
+      self.target_cumulative = list(itertools.accumulate(weights))
+      self.parking_lot_index = {lot: i for i, lot in enumerate(self.parking_lots)}
+
+
+    def choose_target(self, start):
+      """Draw a target parking lot other than start, with the odds of target_weights (uniform by default).
+
+      Raises ValueError when no other lot has a positive weight.
+      """
+      cumulative = self.target_cumulative
+      total = cumulative[-1] if cumulative else 0
+      # Take the start lot's share out of the draw, then skip over it
+      i = self.parking_lot_index.get(start)
+      skipped = 0 if i is None else cumulative[i] - (cumulative[i - 1] if i else 0)
+      if total - skipped <= 0:
+          raise ValueError(f"No parking lot other than {start} to send a car to: every other lot has weight 0.")
+      draw = self.random.random() * (total - skipped)
+      if i is not None and draw >= cumulative[i] - skipped:
+          draw += skipped
+      return self.parking_lots[bisect.bisect_right(cumulative, draw)]
+
+
+    def spawn_cars(self):
+      """Release at most one queued car per spawn point whose cell has no car on it (parked cars don't count),
+      while fewer than spawn_capacity cars are in transit."""
+      room = self.spawn_capacity - self.state_counts["idle"] - self.state_counts["moving"]
+      for point, queue in self.spawn_queues.items():
+        if room <= 0:
+          break
+        if not queue:
+          continue
+        if self.occupancy[point]:
+          continue
+        room -= 1
+
+        i, target_parking = queue.popleft()
+        self.pending_spawns -= 1
+        car = Car(unique_id=-(i+1), start_parking=point, target_parking=target_parking, model=self)
+        self.cars_list.append(car)
+        self.cars_by_id[i + 1] = car
+        self.place_car(car, point)
+        if point not in self.parking_lot_cells:
+          # Road entries start already on the street
+          car.exited_parking = True
+          car.state = "moving"
+
+
+    def place_car(self, car, position):
+      self.grid.place_agent(car, position)
+      self.occupancy[position] += 1
+      self.active_cars.add(car)
+      for semaphore in self.semaphore_index.get(position, ()):
+          semaphore.cars_in_range.add(car.unique_id)
+          self.dirty_semaphores.add(semaphore.controller)
 
 
     def initialize_semaphores(self):
         self.semaphores = {}
-        #Define semaphores coordinates
-        semaphores_positions = {
-            1: [(18, 2), (19, 2)],
-            2: [(17, 0), (17, 1)],
-            3: [(22, 5), (23, 5)],
-            4: [(2, 6), (2, 7)],
-            5: [(0, 8), (1, 8)],
-            6: [(7, 6), (7, 7)],
-            7: [(5, 8), (6, 8)],
-            8: [(21, 6), (21, 7)],
-            9: [(14, 17), (15, 17)],
-            10: [(16, 18), (16, 19)]
-        }
-
-        semaphore_pairs = {
-            1: 2,
-            2: 1,
-            3: 8,
-            8: 3,
-            4: 5,
-            5: 4,
-            6: 7,
-            7: 6,
-            9: 10,
-            10: 9,
-        }
-
-        #Range within which an approaching car is detected
-        semaphore_ranges = {
-        1: [(18, 1), (19, 1), (18, 2), (19, 2), (18, 3), (19, 3), (18, 4), (19, 4)],
-        2: [(15, 0), (15, 1), (16, 0), (16, 1), (17, 0), (17, 1), (18, 0), (18, 1), (19, 0), (19, 1)],
-        3: [(22, 3), (23, 3), (22, 4), (23, 4), (22, 5), (23, 5), (22, 6), (23, 6), (22, 7), (23, 7)],
-        4: [(1, 6), (1, 7), (2, 6), (2, 7), (3, 6), (3, 7), (4, 6), (4, 7)],
-        5: [(0, 6), (1, 6), (0, 7), (1, 7), (0, 8), (1, 8), (0, 9), (1, 9), (0, 10), (1, 10)],
-        6: [(5, 6), (5, 7), (6, 6), (6, 7), (7, 6), (7, 7), (8, 6), (8, 7), (9, 6), (9, 7)],
-        7: [(5, 7), (6, 7), (5, 8), (6, 8), (5, 9), (6, 9), (5, 10), (6, 10)],
-        8: [(19, 6), (19, 7), (20, 6), (20, 7), (21, 6), (21, 7), (22, 6), (22, 7)],
-        9: [(14, 16), (15, 16), (14, 17), (15, 17), (14, 18), (15, 18), (14, 19), (15, 19)],
-        10: [(15, 18), (15, 19), (16, 18), (16, 19), (17, 18), (17, 19), (18, 18), (18, 19)]
-        }
-
-        for semaphore_id, positions in semaphores_positions.items():
-            paired_id = semaphore_pairs.get(semaphore_id, None)
-            range_cells = semaphore_ranges.get(semaphore_id, [])
-            semaphore = SemaphoreAgent(unique_id=semaphore_id, model=self, positions=positions, paired_semaphore=paired_id, range_cells=range_cells)
+        for semaphore_id, spec in self.city_map.semaphores.items():
+            semaphore = SemaphoreAgent(unique_id=semaphore_id, model=self, positions=list(spec.positions),
+                                       green_duration=self.green_duration, red_duration=self.red_duration,
+                                       paired_semaphore=spec.paired, range_cells=list(spec.range_cells))
             self.semaphores[semaphore_id] = semaphore
-            self.grid.place_agent(semaphore, positions[0])#crear agente en 1 tmb
+            self.grid.place_agent(semaphore, semaphore.positions[0])#crear agente en 1 tmb
+
+        for semaphore_id, semaphore in self.semaphores.items():
+            semaphore.controller = self.semaphores[max(semaphore_id, semaphore.paired_semaphore)]
+        self.semaphore_controllers = sorted({semaphore.controller for semaphore in self.semaphores.values()},
+                                            key=lambda semaphore: semaphore.unique_id)
+        # Every pair is evaluated once before the first tick
+        self.dirty_semaphores = set(self.semaphore_controllers)
+        self.semaphore_evaluations = 0
+        self.last_semaphore_evaluations = 0
+
+        # Reverse index: cell -> semaphores whose detection range contains it
+        self.semaphore_index = {}
+        for semaphore in self.semaphores.values():
+            for cell in semaphore.range_cells:
+                self.semaphore_index.setdefault(cell, []).append(semaphore)
 
 
     def initialize_city_objects(self):
-        """Initialize buildings, parking lots and a roundabout on the grid using PropertyLayer."""
+        """Copy the buildings, parking lots and roundabout of self.city_map into the city_objects PropertyLayer."""
         city_objects_layer = mesa.space.PropertyLayer("city_objects", self.grid.width, self.grid.height, np.int64(0), np.int64)
+        city_objects_layer.data[:] = self.city_map.objects
         self.grid.properties["city_objects"] = city_objects_layer
 
-        #Define buildings coordinates
-        buildings = [(2, 2), (3, 2), (4, 2), (5, 2), (6, 2), (7, 2), (8, 2), (10, 2), (11, 2), (3, 3), (4, 3), (5, 3), (6, 3), (7, 3), (8, 3), (9, 3), (10, 3), (11, 3),
-                     (2, 4), (3, 4), (4, 4), (5, 4), (6, 4), (7, 4), (8, 4), (9, 4), (10, 4), (2, 5), (3, 5), (4, 5), (5, 5), (7, 5), (8, 5), (9, 5), (10, 5), (11, 5),
-                     (2, 8), (3, 8), (4, 8), (7, 8), (9, 8), (10, 8), (11, 8), (2, 9), (3, 9), (4, 9), (7, 9), (8, 9), (9, 9), (10, 9), (11, 9), (2, 10), (3, 10), (7, 10),
-                     (8, 10), (9, 10), (10, 10), (2, 11), (3, 11), (4, 11), (7, 11), (8, 11), (9, 11), (10, 11), (11, 11), (16, 2), (17, 2), (20, 2), (21, 2), (16, 3), (20, 3),
-                     (21, 3), (16, 4), (17, 4), (21, 4), (16, 5), (17, 5), (20, 5), (21, 5), (16, 8), (17, 8), (20, 8), (21, 8), (16, 9), (17, 9), (20, 9), (17, 10), (20, 10), (21, 10),
-                     (16, 11), (17, 11), (20, 11), (21, 11), (2, 16), (3, 16), (4, 16), (5, 16), (8, 16), (9, 16), (10, 16), (11, 16), (3, 17), (4, 17), (5, 17), (8, 17), (9, 17), (10, 17),
-                     (11, 17), (2, 18), (3, 18), (4, 18), (5, 18), (8, 18), (9, 18), (10, 18), (11, 18), (2, 19), (3, 19), (4, 19), (5, 19), (8, 19), (9, 19), (10, 19), (11, 19), (2, 20),
-                     (3, 20), (4, 20), (9, 20), (10, 20), (11, 20), (2, 21), (3, 21), (4, 21), (5, 21), (8, 21), (9, 21), (10, 21), (11, 21), (16, 16), (17, 16), (18, 16), (19, 16), (20, 16),
-                     (21, 16), (16, 17), (18, 17), (20, 17), (21, 17), (16, 20), (17, 20), (18, 20), (20, 20), (21, 20), (16, 21), (17, 21), (18, 21), (19, 21), (20, 21), (21, 21)]
-        for (x, y) in buildings:
-            position = (x, y)
-            if self.grid.properties["city_objects"].data[x, y] == 0:
-                self.grid.properties["city_objects"].set_cell(position, 20)
-
-        #Define parking lots coordinates
-        self.parking_lot_map = {}
-        self.parking_lots = [(9, 2), (2, 3), (17, 3), (11, 4), (20, 4), (6, 5), (8, 8), (21, 9), (4, 10), (11, 10), (16, 10), (2, 17), (17, 17), (19, 17), (5, 20), (8, 20), (19, 20)]
-        for parking_id, (x, y) in enumerate(self.parking_lots, start = 1):
-            position = (x, y)
-            value = self.grid.properties["city_objects"].data[position]
-            if value == 0:
-              self.grid.properties["city_objects"].set_cell(position, parking_id)
-              self.parking_lot_map[parking_id] = position
-
-        self.roundabout_cells = [(13, 13), (14, 13), (13, 14), (14, 14)]
-        for position in self.roundabout_cells:
-            self.grid.properties["city_objects"].set_cell(position, 21)
-
-        #Define cars coordinates
-        for car in self.cars_list:
-          position = car.pos
-          value = self.grid.properties["city_objects"].data[position]
-          if value is not None:
-            self.grid.properties["city_objects"].set_cell(position, -1)
-
-        # Define roundabout coordinates
-        for position in self.roundabout_cells:
-            self.grid.properties["city_objects"].set_cell(position, 21)
-
-
-    def update_roundabout(self):
-        for position in self.roundabout_cells:
-            current_value = self.grid.properties["city_objects"].data[position]
-            if current_value != -1:
-                self.grid.properties["city_objects"].set_cell(position, 21)
+        self.parking_lots = list(self.city_map.parking_lots)
+        self.parking_lot_map = {parking_id: position for parking_id, position in enumerate(self.parking_lots, start=1)}
+        self.parking_lot_cells = set(self.parking_lots)
+        self.roundabout_cells = list(self.city_map.roundabout_cells)
+
+
+    def initialize_lane_directions(self):
+        """Per-cell table of allowed headings (bit flags) shared by every car, read-only, from self.city_map."""
+        self.lane_directions = self.city_map.lanes
+
+
+    def snapshot_buffer(self, storage=None):
+        """Binary snapshot of the current tick as a memoryview over a buffer owned by the model
+        (or over storage, a uint8 array of at least snapshot_capacity() bytes).
+
+        Layout (little-endian, no padding):
+          header     magic "CITY", version u16, tick u32, car count u32, semaphore count u32
+          semaphores per semaphore: id i32, light u8 (0 yellow, 1 green, 2 red)
+          cars       per car on the grid: unique_id i32, x i16, y i16,
+                     heading u8 (0 none, 1 up, 2 left, 3 right, 4 down),
+                     state u8 (0 idle, 1 moving, 2 arrived)
+
+        The buffer is reused, so the view is only valid until the next call; bytes(view)
+        is the single copy needed to hand it out.
+        """
+        semaphore_count = len(self.semaphores)
+        if storage is None:
+            if self.snapshot_storage is None:
+                self.snapshot_storage = np.zeros(self.snapshot_capacity(), dtype=np.uint8)
+            storage = self.snapshot_storage
+        cars_offset = SNAPSHOT_HEADER.itemsize + semaphore_count * SEMAPHORE_RECORD.itemsize
+
+        semaphores = storage[SNAPSHOT_HEADER.itemsize:cars_offset].view(SEMAPHORE_RECORD)
+        if self.batch is not None:
+            # Straight from the arrays, so publishing doesn't need the agents in sync
+            semaphores["id"] = self.batch.semaphore_ids
+            semaphores["light"] = self.batch.light
+            count = self.batch.write_car_records(storage[cars_offset:].view(CAR_RECORD))
+        else:
+            for record, (semaphore_id, semaphore) in zip(semaphores, sorted(self.semaphores.items())):
+                record["id"] = semaphore_id
+                record["light"] = LIGHT_CODES[semaphore.light_state]
+            cars = self.cars_list
+            count = len(cars)
+            records = storage[cars_offset:cars_offset + count * CAR_RECORD.itemsize].view(CAR_RECORD)
+            records["id"] = np.fromiter((car.unique_id for car in cars), dtype=np.int32, count=count)
+            records["x"] = np.fromiter((car.pos[0] for car in cars), dtype=np.int16, count=count)
+            records["y"] = np.fromiter((car.pos[1] for car in cars), dtype=np.int16, count=count)
+            records["heading"] = np.fromiter((DIRECTION_CODES[car.direction] for car in cars), dtype=np.uint8, count=count)
+            records["state"] = np.fromiter((STATE_CODES[car.state] for car in cars), dtype=np.uint8, count=count)
+
+        header = storage[:SNAPSHOT_HEADER.itemsize].view(SNAPSHOT_HEADER)
+        header["magic"] = SNAPSHOT_MAGIC
+        header["version"] = SNAPSHOT_VERSION
+        header["tick"] = self.steps
+        header["cars"] = count
+        header["semaphores"] = semaphore_count
+        return memoryview(storage)[:cars_offset + count * CAR_RECORD.itemsize]
+
+
+    def snapshot_capacity(self):
+        """Size in bytes of a snapshot_buffer() with every car on the grid."""
+        return SNAPSHOT_HEADER.itemsize + len(self.semaphores) * SEMAPHORE_RECORD.itemsize + self.num_cars * CAR_RECORD.itemsize
+
+
+    def share_state(self, name=None):
+        """Publish city_objects and the snapshot records to shared memory after every tick (shared_state.py)."""
+        from shared_state import StatePublisher
+        self.publisher = StatePublisher(self, name)
+        return self.publisher
+
+
+    def record_replay(self, path, keyframe_every=100):
+        """Append this tick and every following one to the replay log at path (replay.py)."""
+        from replay import ReplayRecorder
+        self.recorder = ReplayRecorder(self, path, keyframe_every)
+        return self.recorder
+
+
+    def publish_tick(self):
+        """Hand the finished tick to the shared memory publisher and the replay recorder."""
+        if self.publisher is not None:
+            self.publisher.publish()
+        if self.recorder is not None:
+            self.recorder.record()
+
+
+    def update_semaphores(self):
+        """Controller phase: evaluate each semaphore pair touched since the last call exactly once.
+
+        Pairs with cars on both sides stay due for the next call too, so their green can time out
+        (see manage_light_state). Under the fixed policy every pair advances its cycle on every
+        call instead.
+        """
+        dirty_semaphores = self.dirty_semaphores
+        if self.semaphore_policy == "fixed":
+            for semaphore in self.semaphore_controllers:
+                semaphore.manage_fixed_cycle()
+            self.last_semaphore_evaluations = len(self.semaphore_controllers)
+            dirty_semaphores.clear()
+            return
+        contested = [semaphore for semaphore in dirty_semaphores if semaphore.manage_light_state()]
+        self.last_semaphore_evaluations = len(dirty_semaphores)
+        dirty_semaphores.clear()
+        dirty_semaphores.update(contested)
+
+
+    def set_car_target(self, car_id, target_parking):
+        """Give car number car_id a new destination (see Car.set_target).
+
+        Raises ValueError for a number outside 1..num_cars and KeyError for a car that hasn't spawned yet.
+        """
+        if not 1 <= car_id <= self.num_cars:
+            raise ValueError(f"No car number {car_id}; cars are numbered 1 to {self.num_cars}.")
+        if self.batch is not None:
+            self.batch.set_target(car_id - 1, target_parking)
+        else:
+            self.cars_by_id[car_id].set_target(target_parking)
+        self.running = True
+
+
+    def count_cars(self, state):
+        """Number of cars on the grid in state ("idle", "moving" or "arrived"); queued spawns aren't counted."""
+        self.sync_agents()
+        return self.state_counts[state]
+
+
+    def trip_times(self):
+        """Ticks between entering the grid and arriving, for every car that has arrived."""
+        self.sync_agents()
+        return np.array([car.arrival_step - car.departure_step for car in self.cars_list if car.arrival_step is not None],
+                        dtype=np.int64)
+
 
     def step(self):
-      print("Step ", self.steps)
-      for semaphore in self.semaphores.values():
-          semaphore.manage_light_state()
-      self.agents.shuffle_do("step")
-      self.update_roundabout()
-      print(self.grid.properties["city_objects"].data)
-      all_arrived = all(car.state == "arrived" for car in self.cars_list)
+      profiler = self.profiler
+      if profiler is not None:
+          profiler.start()
+      if self.batch is not None:
+          # The agents catch up in sync_agents(), when something reads them
+          self.batch.step()
+          if profiler is not None:
+              profiler.lap("phase.batch_step")
+          if self.publisher is not None or self.recorder is not None:
+              self.publish_tick()
+              if profiler is not None:
+                  profiler.lap("phase.publish")
+          return
+
+      events = self.events
+      if events.level <= DEBUG:
+          events.emit(DEBUG, "step", step=self.steps)
+      if self.pending_spawns:
+          self.spawn_cars()
+      if profiler is not None:
+          profiler.lap("phase.spawn")
+      self.active_cars.shuffle_do("step")
+      if profiler is not None:
+          profiler.lap("phase.agents")
+      self.update_semaphores()
+      if profiler is not None:
+          profiler.lap("phase.semaphores")
+      if events.level <= TRACE:
+          events.emit(TRACE, "city_objects", step=self.steps, data=self.grid.properties["city_objects"].data.copy())
+      if profiler is not None:
+          profiler.lap("phase.trace")
+      all_arrived = not self.pending_spawns and self.state_counts["arrived"] == len(self.cars_list)
       if all_arrived:
-          print("All cars have parked.")
+          if events.level <= INFO:
+              events.emit(INFO, "all_parked", step=self.steps)
           self.running = False
+      if profiler is not None:
+          profiler.lap("phase.termination")
+      if self.publisher is not None or self.recorder is not None:
+          self.publish_tick()
+          if profiler is not None:
+              profiler.lap("phase.publish")
@@ -1,17 +1,101 @@
-from flask import Flask, jsonify
-from Final import CityModel
+import json
+import os
+from collections import namedtuple
+
+from flask import Flask, Response, jsonify, request
+from Final import CityModel, parse_snapshot
+from clock import SimulationClock
+from sessions import SessionManager
+
+# Ticks per second of the background clock. With 0 (default) every /positions call
+# advances the model, as before.
+TICK_RATE = float(os.environ.get("CITY_TICK_RATE", "0"))
+
+# CITY_PROFILE=1 records per-phase timings, served on /metrics
+PROFILE = os.environ.get("CITY_PROFILE", "0") == "1"
+
+city_model = CityModel(cars=17, profile=PROFILE)
+
+# CITY_SHARED_MEMORY=<name> publishes every tick of city_model to that shared memory
+# segment, for local readers (shared_state.StateReader)
+SHARED_MEMORY = os.environ.get("CITY_SHARED_MEMORY")
+if SHARED_MEMORY:
+    city_model.share_state(SHARED_MEMORY)
+
+# CITY_REPLAY=<path> appends every tick of city_model to a replay log (replay.py)
+REPLAY_PATH = os.environ.get("CITY_REPLAY")
+if REPLAY_PATH:
+    city_model.record_replay(REPLAY_PATH)
+
+
+# ids: car numbers (1, 2, ...; the unique_id of a car is its negative), in the order of positions
+Snapshot = namedtuple("Snapshot", ["tick", "ids", "positions", "body", "binary"])
+
+
+def positions_snapshot(model):
+    # From the car records, which the batch engine writes without syncing its agents
+    binary = bytes(model.snapshot_buffer())
+    _, _, cars = parse_snapshot(binary)
+    ids = [-car_id for car_id in cars["id"].tolist()]
+    positions = list(zip(cars["x"].tolist(), cars["y"].tolist()))
+    body = json.dumps([{"x": x, "y": y} for x, y in positions])
+    return Snapshot(model.steps, ids, positions, body, binary)
+
+
+clock = SimulationClock(city_model, TICK_RATE, positions_snapshot) if TICK_RATE > 0 else None
+
+# Independent experiments next to the shared city_model, see /sessions
+sessions = SessionManager(
+    max_sessions=int(os.environ.get("CITY_MAX_SESSIONS", "32")),
+    idle_timeout=float(os.environ.get("CITY_SESSION_IDLE_SECONDS", "600")),
+    max_memory=int(os.environ.get("CITY_SESSION_MEMORY_MB", "512")) * 1024 * 1024,
+)
+SESSION_PARAMS = {"cars": int, "seed": int, "spawn": bool, "engine": str, "routing": bool, "profile": bool}
+PARAM_TYPES = {int: "an integer", bool: "true or false", str: "a string"}
+# Most ticks one /sessions/<id>/step call may run, so a request can't hold a session for minutes
+MAX_SESSION_STEPS = int(os.environ.get("CITY_MAX_SESSION_STEPS", "1000"))
+
+
+def session_params(body):
+    """CityModel keywords from a /sessions body, checked against SESSION_PARAMS. Raises ValueError."""
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object.")
+    params = {}
+    for name, kind in SESSION_PARAMS.items():
+        if name not in body:
+            continue
+        value = body[name]
+        # JSON true/false only: bool("false") is True, and bool is an int too
+        if type(value) is not kind:
+            raise ValueError(f"{name} must be {PARAM_TYPES[kind]}.")
+        params[name] = value
+    if "cars" not in params:
+        raise ValueError("cars is required.")
+    if params["cars"] < 1:
+        raise ValueError("cars must be at least 1.")
+    return params
 
-city_model = CityModel(cars=17)
 
 app = Flask(__name__)
 
+@app.before_request
+def start_clock():
+    if clock is not None:
+        clock.start()
+
 @app.route("/")
 def index():
     return jsonify({"Message": "Hello from the Team 7"})
 
 @app.route("/positions", methods=["GET", "POST"])
 def positions():
+    if clock is not None:
+        # Latest published tick, reading never advances the simulation
+        snapshot = clock.snapshot
+        return Response(snapshot.body, mimetype="application/json", headers={"X-Tick": str(snapshot.tick)})
+
     city_model.step()
+    city_model.sync_agents()
 
     car_positions = []
     for car in city_model.cars_list:
@@ -19,5 +103,145 @@ def positions():
     
     return jsonify(car_positions)
 
+@app.route("/positions.bin", methods=["GET", "POST"])
+def positions_binary():
+    # Same tick as /positions in the binary layout documented in CityModel.snapshot_buffer
+    if clock is not None:
+        snapshot = clock.snapshot
+        return Response(snapshot.binary, mimetype="application/octet-stream", headers={"X-Tick": str(snapshot.tick)})
+
+    city_model.step()
+    return Response(bytes(city_model.snapshot_buffer()), mimetype="application/octet-stream")
+
+@app.route("/stream")
+def stream():
+    """Server-Sent Events: one frame per published tick, [car number, x, y] rows.
+
+    ?mode=delta sends only the cars that moved since the previous frame sent to this
+    client. A client that reads slower than the clock ticks skips frames.
+    """
+    if clock is None:
+        return jsonify({"error": "Streaming needs the background clock, set CITY_TICK_RATE."}), 409
+
+    delta = request.args.get("mode") == "delta"
+    slot = clock.subscribe()
+
+    def frames():
+        last_positions = None
+        try:
+            while True:
+                snapshot = slot.get(timeout=15)
+                if snapshot is None:
+                    if slot.closed:
+                        yield "event: end\ndata: {}\n\n"
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+
+                positions = dict(zip(snapshot.ids, snapshot.positions))
+                if delta and last_positions is not None:
+                    cars = [[car_id, x, y] for car_id, (x, y) in positions.items() if last_positions.get(car_id) != (x, y)]
+                    event = "delta"
+                else:
+                    cars = [[car_id, x, y] for car_id, (x, y) in positions.items()]
+                    event = "snapshot"
+                last_positions = positions
+                data = json.dumps({"tick": snapshot.tick, "cars": cars})
+                yield f"id: {snapshot.tick}\nevent: {event}\ndata: {data}\n\n"
+        finally:
+            clock.unsubscribe(slot)
+
+    return Response(frames(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def metrics_report(model, reset):
+    # Controller cost: semaphore pair evaluations in total and in the last tick, counted even without profiling
+    report = {"tick": model.steps, "enabled": model.profiler is not None,
+              "semaphore_evaluations": model.semaphore_evaluations,
+              "last_semaphore_evaluations": model.last_semaphore_evaluations}
+    profiler = model.profiler
+    if profiler is None:
+        return report
+    report["timings"] = profiler.report()
+    if reset:
+        profiler.reset()
+    return report
+
+@app.route("/metrics")
+def metrics():
+    """Semaphore evaluation counts and, with CITY_PROFILE=1, per-phase and per-method timings of the shared
+    model; ?reset=1 starts the timings over."""
+    reset = request.args.get("reset", default=0, type=int) == 1
+    if clock is None:
+        return jsonify(metrics_report(city_model, reset))
+    with clock.lock:
+        return jsonify(metrics_report(city_model, reset))
+
+@app.route("/sessions", methods=["GET"])
+def list_sessions():
+    return jsonify(sessions.list_sessions())
+
+@app.route("/sessions", methods=["POST"])
+def create_session():
+    # JSON body with CityModel keywords: cars (required), seed, spawn, engine, routing
+    try:
+        params = session_params(request.get_json(silent=True) or {})
+        session_id = sessions.create(**params)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    except MemoryError as error:
+        return jsonify({"error": str(error)}), 413
+    return jsonify({"session_id": session_id}), 201
+
+@app.route("/sessions/<session_id>/step", methods=["POST"])
+def step_session(session_id):
+    try:
+        steps = int(request.args.get("steps", "1"))
+    except ValueError:
+        return jsonify({"error": "steps must be an integer"}), 400
+    if not 1 <= steps <= MAX_SESSION_STEPS:
+        return jsonify({"error": f"steps must be between 1 and {MAX_SESSION_STEPS}"}), 400
+    try:
+        tick = sessions.step(session_id, steps)
+    except KeyError:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"tick": tick})
+
+@app.route("/sessions/<session_id>/positions", methods=["GET"])
+def session_positions(session_id):
+    try:
+        session = sessions.get(session_id)
+    except KeyError:
+        return jsonify({"error": "Session not found"}), 404
+    with session.lock:
+        session.model.sync_agents()
+        car_positions = [{"x": car.pos[0], "y": car.pos[1]} for car in session.model.cars_list]
+        tick = session.model.steps
+    return jsonify({"tick": tick, "car_positions": car_positions})
+
+@app.route("/sessions/<session_id>/positions.bin", methods=["GET"])
+def session_positions_binary(session_id):
+    try:
+        body = sessions.snapshot(session_id)
+    except KeyError:
+        return jsonify({"error": "Session not found"}), 404
+    return Response(body, mimetype="application/octet-stream")
+
+@app.route("/sessions/<session_id>/metrics", methods=["GET"])
+def session_metrics(session_id):
+    try:
+        session = sessions.get(session_id)
+    except KeyError:
+        return jsonify({"error": "Session not found"}), 404
+    with session.lock:
+        return jsonify(metrics_report(session.model, request.args.get("reset", default=0, type=int) == 1))
+
+@app.route("/sessions/<session_id>", methods=["DELETE"])
+def destroy_session(session_id):
+    try:
+        sessions.destroy(session_id)
+    except KeyError:
+        return jsonify({"error": "Session not found"}), 404
+    return "", 204
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=8000, debug=True)
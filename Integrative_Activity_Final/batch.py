@@ -0,0 +1,544 @@
+"""Vectorized stepping engine for CityModel.
+
+BatchEngine keeps every car's position, heading, target and state in NumPy arrays and
+advances the whole fleet with array operations instead of activating Car agents one by
+one. It applies the same rules as the agent path (Car.exit_parking, Car.move,
+Car.is_valid_step, SemaphoreAgent.manage_light_state):
+
+- a car in its parking lot leaves to a random plain road neighbour (city_objects value 0)
+  without a car on it;
+- a car next to its target parking enters it when no car is on it (always in spawn
+  mode, where lots work as garages), otherwise it takes a random step
+  allowed by the lane table onto a cell without a car, never back to last_pos, and onto
+  a red cell (19) only when a green semaphore agent is next to it;
+- a car standing on its target becomes "arrived";
+- after movement, every semaphore pair whose detection range a car entered or left
+  during the tick is evaluated once (CityModel.update_semaphores).
+
+The agent path resolves ties through activation order; here the order is a random
+priority drawn each tick from model.rng. Every move but parking in a garage claims its
+cell; each cell goes to the highest-priority claimant and the other claimants wait, so
+a road cell never holds more than one car. Runs are reproducible for a fixed seed, but the
+random draws differ from the agent path, so both engines produce different (equally
+valid) trajectories.
+
+Car and SemaphoreAgent objects are only refreshed by sync_agents(), which CityModel calls
+when something reads them (CityModel.sync_agents); stepping never does.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from Final import (Car, NEIGHBOR_OFFSETS, NEIGHBOR_BITS, STATE_NAMES, STATE_CODES, DIRECTION_NAMES,
+                   DIRECTION_CODES, LIGHT_NAMES, LIGHT_CODES)
+from events import DEBUG, INFO
+
+IDLE, MOVING, ARRIVED = 0, 1, 2
+YELLOW, GREEN, RED = 0, 1, 2
+LIGHT_VALUES = np.array([25, 18, 19])
+
+# The cells the planned cars want (dest, flat)
+MovePlan = namedtuple("MovePlan", ["idx", "choice", "exiting", "to_target", "has_step", "dest_x", "dest_y", "dest",
+                                   "claims"])
+
+
+def first_claims(dest, claims, priority):
+    """Winner mask: on each destination cell the claim with the lowest priority value wins."""
+    order = np.lexsort((priority, dest))
+    ranked = order[claims[order]]
+    winner = np.zeros(dest.size, dtype=bool)
+    first = np.ones(ranked.size, dtype=bool)
+    first[1:] = dest[ranked][1:] != dest[ranked][:-1]
+    winner[ranked[first]] = True
+    return winner
+
+
+class BatchEngine:
+    """Array-based stepping of every car and semaphore of a CityModel."""
+
+    def __init__(self, model):
+        self.model = model
+        self.rng = model.rng
+        self.layer = model.grid.properties["city_objects"].data
+        # Shared with the model: cars per cell, updated as the cars move
+        self.occupancy = model.occupancy
+        self.width, self.height = self.layer.shape
+        self.lanes = model.lane_directions
+
+        n = model.num_cars
+        self.x = np.zeros(n, dtype=np.int64)
+        self.y = np.zeros(n, dtype=np.int64)
+        self.last_x = np.full(n, -1, dtype=np.int64)
+        self.last_y = np.full(n, -1, dtype=np.int64)
+        self.target_x = np.zeros(n, dtype=np.int64)
+        self.target_y = np.zeros(n, dtype=np.int64)
+        self.direction = np.zeros(n, dtype=np.int8)
+        self.state = np.zeros(n, dtype=np.int8)
+        self.exited = np.zeros(n, dtype=bool)
+        self.alive = np.zeros(n, dtype=bool)
+        self.departure_step = np.zeros(n, dtype=np.int64)
+        self.arrival_step = np.full(n, -1, dtype=np.int64)
+        # Cars whose agent is out of date since the last sync_agents()
+        self.dirty = np.zeros(n, dtype=bool)
+        self.cars = [None] * n
+
+        for car in model.cars_list:
+            i = -car.unique_id - 1
+            self.cars[i] = car
+            self.x[i], self.y[i] = car.pos
+            if car.last_pos is not None:
+                self.last_x[i], self.last_y[i] = car.last_pos
+            self.target_x[i], self.target_y[i] = car.target_parking
+            self.direction[i] = DIRECTION_CODES[car.direction]
+            self.state[i] = STATE_CODES[car.state]
+            self.exited[i] = car.exited_parking
+            self.alive[i] = True
+            self.departure_step[i] = car.departure_step
+            if car.arrival_step is not None:
+                self.arrival_step[i] = car.arrival_step
+
+        # Termination counters, so the end-of-tick check doesn't scan the fleet
+        self.alive_count = int(self.alive.sum())
+        self.arrived_count = int((self.alive & (self.state == ARRIVED)).sum())
+
+        self.initialize_spawn_queues()
+        self.initialize_semaphores()
+        self.initialize_routes()
+
+
+    def initialize_spawn_queues(self):
+        """Flatten CityModel.spawn_queues into per-point slices of one index array."""
+        points = list(self.model.spawn_queues)
+        parking = set(self.model.parking_lots)
+        self.spawn_x = np.array([p[0] for p in points], dtype=np.int64)
+        self.spawn_y = np.array([p[1] for p in points], dtype=np.int64)
+        self.spawn_is_entry = np.array([p not in parking for p in points], dtype=bool)
+
+        queued = []
+        starts = []
+        for p, point in enumerate(points):
+            starts.append(len(queued))
+            for i, (tx, ty) in self.model.spawn_queues[point]:
+                self.x[i], self.y[i] = point
+                self.target_x[i], self.target_y[i] = tx, ty
+                queued.append(i)
+        self.spawn_order = np.array(queued, dtype=np.int64)
+        self.spawn_head = np.array(starts, dtype=np.int64)
+        self.spawn_end = np.append(self.spawn_head[1:], len(queued)).astype(np.int64)
+        self.spawn_point_of = np.zeros(len(self.x), dtype=np.int64)
+        for p in range(len(points)):
+            self.spawn_point_of[self.spawn_order[self.spawn_head[p]:self.spawn_end[p]]] = p
+        self.spawn_points = points
+        self.pending = len(queued)
+
+
+    def initialize_semaphores(self):
+        semaphores = self.model.semaphores
+        self.semaphore_ids = sorted(semaphores)
+        index = {semaphore_id: s for s, semaphore_id in enumerate(self.semaphore_ids)}
+
+        # Each pair once, as (lower id, higher id)
+        pairs = sorted({tuple(sorted((sid, semaphores[sid].paired_semaphore))) for sid in self.semaphore_ids})
+        self.pair_a = np.array([index[a] for a, _ in pairs], dtype=np.int64)
+        self.pair_b = np.array([index[b] for _, b in pairs], dtype=np.int64)
+        self.pair_of = np.zeros(len(self.semaphore_ids), dtype=np.int64)
+        self.pair_of[self.pair_a] = np.arange(len(pairs))
+        self.pair_of[self.pair_b] = np.arange(len(pairs))
+
+        light_cells = [(x, y, index[sid]) for sid in self.semaphore_ids for x, y in semaphores[sid].positions]
+        range_cells = [(x, y, index[sid]) for sid in self.semaphore_ids for x, y in semaphores[sid].range_cells]
+        agent_cells = [semaphores[sid].pos for sid in self.semaphore_ids]
+        self.light_x, self.light_y, self.light_owner = np.array(light_cells, dtype=np.int64).reshape(-1, 3).T
+        range_x, range_y, self.range_owner = np.array(range_cells, dtype=np.int64).reshape(-1, 3).T
+        self.range_flat = range_x * self.height + range_y
+        self.agent_x, self.agent_y = np.array(agent_cells, dtype=np.int64).reshape(-1, 2).T
+
+        self.light = np.array([LIGHT_CODES[semaphores[sid].light_state] for sid in self.semaphore_ids], dtype=np.int8)
+        self.present = np.zeros(len(self.semaphore_ids), dtype=bool)
+        # The controller's (higher id) step_counter: position of each pair in its cycle under the fixed policy,
+        # evaluations the current green has lasted with cars on both sides under the actuated one
+        controllers = [semaphores[self.semaphore_ids[b]] for b in self.pair_b]
+        self.cycle = np.array([semaphore.step_counter for semaphore in controllers], dtype=np.int64)
+        # Pairs with cars on both sides, evaluated again next tick (the controllers left in dirty_semaphores)
+        self.contested = np.array([semaphore in self.model.dirty_semaphores for semaphore in controllers], dtype=bool)
+        self.green_duration = np.array([semaphore.green_duration for semaphore in controllers], dtype=np.int64)
+        self.cycle_length = self.green_duration + np.array([semaphore.red_duration for semaphore in controllers], dtype=np.int64)
+        self.green_near = np.zeros((self.width, self.height), dtype=bool)
+
+
+    def initialize_routes(self):
+        """Forget every car's row in the hop grids of the model's lanes; route_hops looks them up again."""
+        self.route_grids = None
+        routes = self.model.routes
+        if routes is None:
+            return
+        self.route_grids = routes.current()
+        # Slot of route_grids holding each car's target (-1: not looked up yet; see HopGrids.owner)
+        self.route_slot = np.full(len(self.x), -1, dtype=np.int64)
+
+
+    def step(self):
+        """Advance every car and semaphore by one tick."""
+        if self.route_grids is not None and self.route_grids is not self.model.routes.current():
+            self.initialize_routes()
+        changed = []
+        if self.pending:
+            changed.append(self.spawn_cars())
+
+        active, at_target = self.arrive_cars()
+
+        movers = np.flatnonzero(active & ~at_target)
+        if movers.size:
+            changed.append(self.move_cars(movers))
+
+        if self.model.semaphore_policy == "fixed":
+            pairs = np.arange(len(self.pair_a))
+        else:
+            pairs = self.touched_pairs(np.concatenate(changed) if changed else np.zeros(0, dtype=np.int64))
+        if len(pairs):
+            self.update_lights(pairs)
+        self.model.semaphore_evaluations += len(pairs)
+        self.model.last_semaphore_evaluations = len(pairs)
+
+        if not self.pending and self.arrived_count == self.alive_count:
+            self.model.running = False
+            events = self.model.events
+            if events.level <= INFO:
+                events.emit(INFO, "all_parked", step=self.model.steps)
+
+
+    def run(self, steps):
+        """Advance several ticks, skipping the mesa step wrapper; the agents stay as they were (see sync_agents)."""
+        for _ in range(steps):
+            if not self.model.running:
+                break
+            # Bypasses CityModel.step, so count the tick like mesa's step wrapper does
+            self.model.steps += 1
+            self.step()
+
+
+    def spawn_cars(self):
+        """Release the head of every spawn queue whose cell holds no car (parked cars don't count),
+        while fewer than CityModel.spawn_capacity cars are in transit."""
+        occupied = self.occupancy[self.spawn_x, self.spawn_y] > 0
+        room = self.model.spawn_capacity - (self.alive_count - self.arrived_count)
+        ready = np.flatnonzero((self.spawn_head < self.spawn_end) & ~occupied)[:max(room, 0)]
+        if not ready.size:
+            return np.zeros(0, dtype=np.int64)
+        spawned = self.spawn_order[self.spawn_head[ready]]
+        self.spawn_head[ready] += 1
+        self.pending -= spawned.size
+        self.model.pending_spawns = self.pending
+
+        self.alive[spawned] = True
+        self.alive_count += spawned.size
+        self.dirty[spawned] = True
+        self.departure_step[spawned] = self.model.steps
+        self.occupancy[self.x[spawned], self.y[spawned]] += 1
+        entry = self.spawn_is_entry[ready]
+        road_cars = spawned[entry]
+        self.exited[road_cars] = True
+        self.state[road_cars] = MOVING
+        return self.x[spawned] * self.height + self.y[spawned]
+
+
+    def arrive_cars(self):
+        """Mark the moving cars standing on their target as arrived; returns (active, at_target) masks."""
+        active = self.alive & (self.state != ARRIVED)
+        at_target = active & self.exited & (self.x == self.target_x) & (self.y == self.target_y)
+        if at_target.any():
+            self.arrived_count += int(at_target.sum())
+            self.state[at_target] = ARRIVED
+            self.direction[at_target] = 0
+            self.arrival_step[at_target] = self.model.steps
+            self.dirty[at_target] = True
+            if self.model.spawn:
+                np.subtract.at(self.occupancy, (self.x[at_target], self.y[at_target]), 1)
+            events = self.model.events
+            if events.level <= INFO:
+                for i in np.flatnonzero(at_target):
+                    events.emit(INFO, "car_arrived", step=self.model.steps, car=-(int(i) + 1),
+                                pos=(int(self.x[i]), int(self.y[i])))
+        return active, at_target
+
+
+    def set_target(self, i, target):
+        """Car.set_target for car index i (unique_id -(i + 1)).
+
+        Raises ValueError for an index outside the fleet and KeyError if the car hasn't spawned.
+        """
+        if not 0 <= i < len(self.x):
+            raise ValueError(f"No car number {i + 1}; cars are numbered 1 to {len(self.x)}.")
+        if not self.alive[i]:
+            raise KeyError(i + 1)
+        self.target_x[i], self.target_y[i] = target
+        if self.state[i] == ARRIVED:
+            self.state[i] = IDLE
+            self.exited[i] = False
+            self.last_x[i] = self.last_y[i] = -1
+            self.departure_step[i] = self.model.steps
+            self.arrival_step[i] = -1
+            if self.model.spawn:
+                self.occupancy[self.x[i], self.y[i]] += 1
+            self.arrived_count -= 1
+        self.dirty[i] = True
+        if self.route_grids is not None:
+            self.route_slot[i] = -1
+
+
+    def route_hops(self, idx, x, y):
+        """Index in NEIGHBOR_OFFSETS of each car's next hop from (x, y) (-1: no route)."""
+        grids = self.route_grids
+        target = self.target_x[idx] * self.height + self.target_y[idx]
+        slots = self.route_slot[idx]
+        # Cars not looked up yet, or whose slot went to another destination since
+        stale = slots < 0
+        stale[~stale] = grids.owner[slots[~stale]] != target[~stale]
+        with grids.lock:
+            tick = grids.uses
+            grids.touch(slots[~stale])
+            new = idx[stale]
+            if new.size:
+                # dict lookups, plus one search for targets no car went to yet; no row used this
+                # tick is given up, so with more targets than rows some cars stay unrouted (-1)
+                self.route_slot[new] = [grids.slot(destination, tick) for destination in
+                                        zip(self.target_x[new].tolist(), self.target_y[new].tolist())]
+            slots = self.route_slot[idx]
+            routed = slots >= 0
+            hops = np.full(idx.size, -1, dtype=np.int8)
+            hops[routed] = grids.hops(slots[routed], x[routed] * self.height + y[routed])
+        return hops
+
+
+    def occupancy_counts(self, cars=None):
+        """Number of cars (of the cars mask, if given) on each cell, flattened as x * height + y."""
+        cars = self.alive if cars is None else self.alive & cars
+        flat = self.x[cars] * self.height + self.y[cars]
+        return np.bincount(flat, minlength=self.width * self.height)
+
+
+    def touched_pairs(self, cells):
+        """Pairs with a semaphore whose detection range contains one of the flat cells, plus the contested ones."""
+        hits = np.bincount(cells, minlength=self.width * self.height)[self.range_flat] > 0
+        pairs = self.contested.copy()
+        pairs[self.pair_of[self.range_owner[hits]]] = True
+        return np.flatnonzero(pairs)
+
+
+    def update_lights(self, pairs=None, counts=None):
+        """Evaluate semaphore pairs like manage_light_state called on the higher id.
+
+        The side with cars in range turns green; with cars on both, the side holding green
+        keeps it for green_duration evaluations, then yields (the higher id when neither is
+        green); with none, both are yellow. Under the fixed policy the pairs follow their
+        cycle instead (manage_fixed_cycle). counts overrides the number of cars in each
+        semaphore's range (see presence_counts).
+        """
+        if counts is None:
+            counts = self.presence_counts()
+        a, b = self.pair_a, self.pair_b
+        if pairs is not None:
+            a, b = a[pairs], b[pairs]
+        present_a, present_b = counts[a] > 0, counts[b] > 0
+        self.present[a] = present_a
+        self.present[b] = present_b
+        if self.model.semaphore_policy == "fixed":
+            selected = np.arange(len(self.pair_a)) if pairs is None else pairs
+            green_b = self.cycle[selected] < self.green_duration[selected]
+            self.cycle[selected] = (self.cycle[selected] + 1) % self.cycle_length[selected]
+            self.light[a] = np.where(green_b, RED, GREEN)
+            self.light[b] = np.where(green_b, GREEN, RED)
+        else:
+            selected = np.arange(len(self.pair_a)) if pairs is None else pairs
+            contested = present_a & present_b
+            counter = self.cycle[selected]
+            keep_b = (self.light[a] != GREEN) ^ (counter >= self.green_duration[selected])
+            switched = (self.light[b] == GREEN) != keep_b
+            self.cycle[selected] = np.where(contested & ~switched, counter + 1, 0)
+            self.contested[selected] = contested
+            green_b = np.where(contested, keep_b, present_b)
+            self.light[a] = np.where(green_b, RED, np.where(present_a, GREEN, YELLOW))
+            self.light[b] = np.where(green_b, GREEN, np.where(present_a, RED, YELLOW))
+
+        evaluated = np.zeros(len(self.semaphore_ids), dtype=bool)
+        evaluated[a] = True
+        evaluated[b] = True
+        self.paint_lights(evaluated)
+
+
+    def presence_counts(self):
+        """Number of cars in each semaphore's detection range."""
+        return np.bincount(self.range_owner, weights=self.occupancy_counts()[self.range_flat],
+                           minlength=len(self.semaphore_ids))
+
+
+    def paint_lights(self, semaphores=None):
+        """Write the light of the semaphores (bool mask, default all) on city_objects and refresh green_near."""
+        cells = slice(None) if semaphores is None else semaphores[self.light_owner]
+        self.layer[self.light_x[cells], self.light_y[cells]] = LIGHT_VALUES[self.light[self.light_owner[cells]]]
+
+        green = np.zeros((self.width, self.height), dtype=bool)
+        is_green = self.light == GREEN
+        green[self.agent_x[is_green], self.agent_y[is_green]] = True
+        near = self.green_near
+        near[:] = False
+        near[1:, :] |= green[:-1, :]
+        near[:-1, :] |= green[1:, :]
+        near[:, 1:] |= green[:, :-1]
+        near[:, :-1] |= green[:, 1:]
+
+
+    def move_cars(self, idx):
+        """Move the given cars one cell; returns the flat cells they left and entered."""
+        plan = self.plan_moves(idx)
+        # Cells that must be free go to the highest-priority claimant
+        priority = self.rng.permutation(idx.size)
+        return self.apply_moves(plan, first_claims(plan.dest, plan.claims, priority))
+
+
+    def plan_moves(self, idx):
+        """Pick the cell each of the given cars wants to move to (the first half of move_cars)."""
+        layer = self.layer
+        k = idx.size
+        x, y = self.x[idx], self.y[idx]
+        nx = x[:, None] + NEIGHBOR_OFFSETS[:, 0]
+        ny = y[:, None] + NEIGHBOR_OFFSETS[:, 1]
+        inside = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+        nxc = np.clip(nx, 0, self.width - 1)
+        nyc = np.clip(ny, 0, self.height - 1)
+        cell = layer[nxc, nyc]
+        empty = inside & (self.occupancy[nxc, nyc] == 0)
+        free = empty & (cell == 0)
+
+        exiting = ~self.exited[idx]
+        is_target = (nx == self.target_x[idx, None]) & (ny == self.target_y[idx, None])
+        # In spawn mode lots work as garages (see Car.move)
+        to_target = ~exiting & (is_target & (empty | self.model.spawn)).any(axis=1)
+
+        # Car.is_valid_step: never back to last_pos nor onto a car; red cells only next to a green semaphore
+        not_back = ~((nx == self.last_x[idx, None]) & (ny == self.last_y[idx, None]))
+        lane_ok = (self.lanes[nxc, nyc] & NEIGHBOR_BITS) != 0
+        valid = empty & not_back & np.where(cell == 19, self.green_near[nxc, nyc], lane_ok)
+
+        # Random choice among the options: free cells when leaving parking, valid steps otherwise
+        options = np.where(exiting[:, None], free, valid)
+        count = options.sum(axis=1)
+        pick = np.floor(self.rng.random(k) * count)
+        choice = np.argmax(np.cumsum(options, axis=1) > pick[:, None], axis=1)
+        rows = np.arange(k)
+        has_step = count > 0
+
+        if self.route_grids is not None:
+            # Follow the route when its next hop is an option; wait at a red light or an occupied target
+            hop = self.route_hops(idx, x, y)
+            routed = hop >= 0
+            hop = np.where(routed, hop, 0)
+            take = routed & options[rows, hop]
+            choice = np.where(take, hop, choice)
+            wait = routed & ~take & ~exiting & ((cell[rows, hop] == 19) | is_target[rows, hop])
+            has_step &= ~wait
+
+        dest_x = np.where(to_target, self.target_x[idx], nx[rows, choice])
+        dest_y = np.where(to_target, self.target_y[idx], ny[rows, choice])
+        claims = has_step | to_target
+        return MovePlan(idx, choice, exiting, to_target, has_step, dest_x, dest_y, dest_x * self.height + dest_y, claims)
+
+
+    def apply_moves(self, plan, winner):
+        """Carry out a plan, where winner marks the claims that got their cell; returns left and entered cells."""
+        idx, choice, exiting, to_target, has_step = plan.idx, plan.choice, plan.exiting, plan.to_target, plan.has_step
+        dest_x, dest_y, claims = plan.dest_x, plan.dest_y, plan.claims
+
+        # Every move needs its cell to itself but parking in a garage (spawn mode), where any number of cars fit.
+        # A car losing the race for its cell waits this tick.
+        garage = to_target & self.model.spawn
+        accepted = claims & (winner | garage)
+        target_move = to_target & accepted
+        lane_move = ~exiting & ~to_target & has_step & accepted
+        exit_move = exiting & accepted
+        moved = target_move | lane_move | exit_move
+        stuck = ~exiting & ~moved
+
+        cars = idx[moved]
+        left = self.x[cars] * self.height + self.y[cars]
+        np.subtract.at(self.occupancy, (self.x[cars], self.y[cars]), 1)
+        onroad = idx[target_move | lane_move]
+        self.last_x[onroad] = self.x[onroad]
+        self.last_y[onroad] = self.y[onroad]
+        self.direction[idx[lane_move]] = choice[lane_move] + 1
+        self.x[cars] = dest_x[moved]
+        self.y[cars] = dest_y[moved]
+        self.exited[cars] = True
+        self.state[cars] = MOVING
+        self.state[idx[stuck]] = IDLE
+        np.add.at(self.occupancy, (self.x[cars], self.y[cars]), 1)
+        self.dirty[idx[moved | stuck]] = True
+
+        events = self.model.events
+        if events.level <= DEBUG:
+            for j in np.flatnonzero(moved):
+                i = int(idx[j])
+                events.emit(DEBUG, "car_exited_parking" if exit_move[j] else "car_moved", step=self.model.steps,
+                            car=-(i + 1), to=(int(self.x[i]), int(self.y[i])))
+
+        return np.concatenate([left, self.x[cars] * self.height + self.y[cars]])
+
+
+    def write_car_records(self, records):
+        """Fill CAR_RECORD rows for the cars on the grid; returns how many were written."""
+        cars = np.flatnonzero(self.alive)
+        count = cars.size
+        records = records[:count]
+        records["id"] = -(cars + 1)
+        records["x"] = self.x[cars]
+        records["y"] = self.y[cars]
+        records["heading"] = self.direction[cars]
+        records["state"] = self.state[cars]
+        return count
+
+
+    def sync_agents(self):
+        """Copy the array state back into the Car and SemaphoreAgent objects."""
+        model = self.model
+        grid = model.grid
+        for i in np.flatnonzero(self.dirty):
+            car = self.cars[i]
+            position = (int(self.x[i]), int(self.y[i]))
+            if car is None:
+                point = self.spawn_points[self.spawn_point_of[i]]
+                model.spawn_queues[point].popleft()
+                car = Car(unique_id=-(int(i) + 1), start_parking=point,
+                          target_parking=(int(self.target_x[i]), int(self.target_y[i])), model=model)
+                self.cars[i] = car
+                model.cars_list.append(car)
+                model.cars_by_id[int(i) + 1] = car
+                grid.place_agent(car, position)
+            elif car.pos != position:
+                grid.move_agent(car, position)
+            car.target_parking = (int(self.target_x[i]), int(self.target_y[i]))
+            car.state = STATE_NAMES[self.state[i]]
+            car.direction = DIRECTION_NAMES[self.direction[i]]
+            car.last_pos = (int(self.last_x[i]), int(self.last_y[i])) if self.last_x[i] >= 0 else None
+            car.exited_parking = bool(self.exited[i])
+            car.departure_step = int(self.departure_step[i])
+            car.arrival_step = int(self.arrival_step[i]) if self.arrival_step[i] >= 0 else None
+        self.dirty[:] = False
+
+        # waiting_cars: ids of the cars currently inside each semaphore's range
+        flat = self.x * self.height + self.y
+        in_range = np.zeros(self.width * self.height, dtype=bool)
+        in_range[self.range_flat] = True
+        cars_at = {}
+        for i in np.flatnonzero(self.alive & in_range[flat]):
+            cars_at.setdefault(int(flat[i]), []).append(-(int(i) + 1))
+        waiting = [set() for _ in self.semaphore_ids]
+        for flat, owner in zip(self.range_flat, self.range_owner):
+            waiting[owner].update(cars_at.get(int(flat), ()))
+        for s, semaphore_id in enumerate(self.semaphore_ids):
+            semaphore = model.semaphores[semaphore_id]
+            semaphore.light_state = LIGHT_NAMES[self.light[s]]
+            semaphore.cars_in_range = waiting[s]
+            semaphore.waiting_cars = set(waiting[s])
+        for p, b in enumerate(self.pair_b):
+            model.semaphores[self.semaphore_ids[b]].step_counter = int(self.cycle[p])
+        model.dirty_semaphores = {model.semaphores[self.semaphore_ids[b]] for b in self.pair_b[self.contested]}
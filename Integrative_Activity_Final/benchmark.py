@@ -0,0 +1,204 @@
+"""Benchmarks for the traffic model hot paths (Car.move, Car.is_valid_step,
+SemaphoreAgent.manage_light_state and CityModel.step all run inside a tick).
+
+For every variant, fleet size and grid size it measures model construction time, per-tick
+latency percentiles and steps per second, and writes them as JSON:
+
+    python benchmark.py --cars 5,17,100,1000 --ticks 500 -o bench.json
+    python benchmark.py --compare before.json after.json
+
+Variants:
+  final     this directory's CityModel, agent engine
+  batch     this directory's CityModel, engine="batch"
+  delivery  the CityModel of "Integrative Activity 2 - Final Delivery" (its prints go to os.devnull)
+
+Fleets above 17 cars use spawn queues in final/batch; the delivery model only has its 17
+parking lots and skips them. A model that finishes before the requested number of ticks
+is replaced by a fresh one with the next seed, so every measurement covers the same
+number of ticks. A grid size of 24 is the hand-drawn city, other sizes are generated with
+citygen.generate_city(size, size, seed=0); --maps benchmarks map files (city_map.py),
+keyed by file name. Large maps spend most of their first ticks building routes; use
+--no-routing to measure random-walk stepping alone.
+"""
+import argparse
+import contextlib
+import functools
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import mesa
+import numpy as np
+
+from Final import CityModel
+from city_map import load_map
+from citygen import generate_city
+from events import NullSink
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DELIVERY_PATH = os.path.join(HERE, "..", "Integrative Activity 2 - Final Delivery", "Final.py")
+DEFAULT_GRID = 24
+MAX_PARKED_CARS = 17
+
+_delivery_module = None
+
+
+def load_delivery():
+    """Import the delivery Final.py under another module name so it doesn't clash with ours."""
+    global _delivery_module
+    if _delivery_module is None:
+        spec = importlib.util.spec_from_file_location("delivery_final", DELIVERY_PATH)
+        _delivery_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_delivery_module)
+    return _delivery_module
+
+
+def model_factory(variant, cars, grid, city_map=None, routing=True):
+    """Function seed -> new model, or the reason this combination can't be measured."""
+    if variant == "delivery":
+        if city_map is not None:
+            return None, "delivery model only has its built-in map"
+        if grid != DEFAULT_GRID:
+            return None, "delivery model only has its built-in map"
+        if cars > MAX_PARKED_CARS:
+            return None, f"delivery model has only {MAX_PARKED_CARS} parking lots"
+        delivery = load_delivery()
+        return lambda seed: delivery.CityModel(cars=cars, seed=seed), None
+    if city_map is None and grid != DEFAULT_GRID:
+        city_map = generated_map(grid)
+    engine = "batch" if variant == "batch" else "agents"
+    spawn = cars > (MAX_PARKED_CARS if city_map is None else len(city_map.parking_lots))
+    return lambda seed: CityModel(cars=cars, seed=seed, spawn=spawn, engine=engine, events=NullSink(),
+                                  city_map=city_map, routing=routing), None
+
+
+@functools.lru_cache(maxsize=None)
+def generated_map(size):
+    return generate_city(size, size, seed=0)
+
+
+def measure(factory, ticks, seed=0):
+    """Run `ticks` ticks, rebuilding the model whenever it finishes; returns the raw timings in ns."""
+    construct = []
+    tick = np.zeros(ticks, dtype=np.int64)
+    model = None
+    for t in range(ticks):
+        if model is None or not model.running:
+            started = time.perf_counter_ns()
+            model = factory(seed + len(construct))
+            construct.append(time.perf_counter_ns() - started)
+        started = time.perf_counter_ns()
+        model.step()
+        tick[t] = time.perf_counter_ns() - started
+    return np.array(construct, dtype=np.int64), tick
+
+
+def summarize(construct, tick):
+    return {
+        "models": int(construct.size),
+        "construct_ms": {"mean": construct.mean() / 1e6, "min": construct.min() / 1e6},
+        "tick_us": {f"p{q}": float(np.percentile(tick, q)) / 1e3 for q in (50, 90, 99)} | {"max": tick.max() / 1e3},
+        "steps_per_sec": tick.size / (tick.sum() / 1e9),
+    }
+
+
+def run_benchmarks(variants, cars, grids, ticks, warmup=20, maps=(), routing=True):
+    """maps: CityMap objects benchmarked next to the grid sizes."""
+    layouts = [(grid, None) for grid in grids] + [(city_map.width, city_map) for city_map in maps]
+    results = []
+    for variant in variants:
+        for grid, city_map in layouts:
+            for car_count in cars:
+                entry = {"variant": variant, "cars": car_count, "grid": grid, "ticks": ticks, "routing": routing}
+                if city_map is not None:
+                    entry["map"] = city_map.name
+                factory, skipped = model_factory(variant, car_count, grid, city_map, routing)
+                if factory is None:
+                    entry["skipped"] = skipped
+                else:
+                    # Delivery prints every move and the whole grid each tick
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        measure(factory, warmup)
+                        entry.update(summarize(*measure(factory, ticks)))
+                results.append(entry)
+                print(format_entry(entry), file=sys.stderr)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+            "numpy": np.__version__, "mesa": mesa.__version__, "machine": platform.machine()}
+
+
+def format_entry(entry):
+    name = f"{entry['variant']:9} cars={entry['cars']:<6} grid={entry.get('map', entry['grid']):<4}"
+    if "skipped" in entry:
+        return f"{name} skipped: {entry['skipped']}"
+    tick = entry["tick_us"]
+    return (f"{name} construct {entry['construct_ms']['mean']:8.2f} ms  tick p50 {tick['p50']:9.1f} us  "
+            f"p99 {tick['p99']:9.1f} us  {entry['steps_per_sec']:9.1f} steps/s")
+
+
+def compare(baseline_path, current_path):
+    """Print the steps/sec and p50 tick ratios (current / baseline) of every benchmark in both files."""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    with open(current_path) as file:
+        current = json.load(file)
+    key = lambda entry: (entry["variant"], entry["cars"], entry["grid"], entry.get("map"))
+    before = {key(entry): entry for entry in baseline["results"] if "skipped" not in entry}
+    print(f"{baseline['environment']['commit']} -> {current['environment']['commit']}")
+    for entry in current["results"]:
+        old = before.get(key(entry))
+        if old is None or "skipped" in entry:
+            continue
+        speedup = entry["steps_per_sec"] / old["steps_per_sec"]
+        latency = entry["tick_us"]["p50"] / old["tick_us"]["p50"]
+        print(f"{entry['variant']:9} cars={entry['cars']:<6} grid={entry.get('map', entry['grid']):<4} "
+              f"steps/s x{speedup:6.2f}  p50 tick x{latency:6.2f}")
+
+
+def parse_ints(text):
+    return [int(part) for part in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CityModel construction and ticks.")
+    parser.add_argument("--variants", default="final,batch,delivery")
+    parser.add_argument("--cars", default="5,17,100,1000", help="fleet sizes")
+    parser.add_argument("--grids", default=str(DEFAULT_GRID), help="grid sizes (width = height)")
+    parser.add_argument("--maps", default="", help="map files (ASCII or .npz) to benchmark as well")
+    parser.add_argument("--routing", action=argparse.BooleanOptionalAction, default=True,
+                        help="cars follow cached shortest routes (default) or walk randomly")
+    parser.add_argument("--ticks", type=int, default=300, help="measured ticks per benchmark")
+    parser.add_argument("-o", "--output", help="JSON file (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = {"environment": environment(),
+              "results": run_benchmarks(args.variants.split(","), parse_ints(args.cars), parse_ints(args.grids),
+                                        args.ticks, maps=[load_map(path) for path in args.maps.split(",") if path],
+                                        routing=args.routing)}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
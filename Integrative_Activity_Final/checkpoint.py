@@ -0,0 +1,218 @@
+"""Save a running CityModel to a file and resume it later, exactly where it stopped.
+
+    save_checkpoint(model, "tick500.npz")
+    model = load_checkpoint("tick500.npz")
+
+A checkpoint is one compressed .npz file:
+
+    map_*             the CityMap (city_map.map_arrays)
+    layer             city_objects as it is now, lights included (occupancy is rebuilt from the cars)
+    cars              one CHECKPOINT_CAR row per car on the grid, in cars_list order
+    active            unique_ids of the cars the agent engine still steps, in AgentSet order
+    semaphores        one CHECKPOINT_SEMAPHORE row per semaphore
+    waiting, in_range (semaphore id, car unique_id) rows of waiting_cars and cars_in_range
+    dirty             map ids of the controllers due for evaluation
+    queues, entries   queued spawns (x, y, car index, target x, target y) and the road entry points
+    route_*           the HopGrids rows (destinations, packed hops), so restored cars don't search their routes again
+    random_state      the random.Random state; meta holds the parameters, counters and numpy bit generator state
+
+load_checkpoint builds the agents from these rows instead of running the initialize_*
+methods, so a restore costs about as much as reading the file. The restored model steps
+exactly like the original would have (same RNG states, same agent order). Event sinks and
+profilers are not saved; pass events= to load_checkpoint.
+"""
+import json
+from collections import deque
+
+import mesa
+import numpy as np
+from mesa.agent import AgentSet
+
+from Final import (CityModel, Car, SemaphoreAgent, STATE_NAMES, STATE_CODES, DIRECTION_NAMES, DIRECTION_CODES,
+                   LIGHT_NAMES, LIGHT_CODES)
+from city_map import map_arrays, map_from_arrays
+from events import NullSink
+
+CHECKPOINT_VERSION = 2
+CHECKPOINT_CAR = np.dtype([("id", "<i4"), ("start_x", "<i4"), ("start_y", "<i4"), ("x", "<i4"), ("y", "<i4"),
+                           ("last_x", "<i4"), ("last_y", "<i4"), ("target_x", "<i4"), ("target_y", "<i4"),
+                           ("direction", "u1"), ("state", "u1"), ("exited", "?"), ("departure_step", "<i8"),
+                           ("arrival_step", "<i8")])
+CHECKPOINT_SEMAPHORE = np.dtype([("id", "<i4"), ("light", "u1"), ("step_counter", "<i4")])
+
+
+def save_checkpoint(model, path):
+    model.sync_agents()
+    cars = np.array([(car.unique_id, *car.start_parking, *car.pos, *(car.last_pos or (-1, -1)), *car.target_parking,
+                      DIRECTION_CODES[car.direction], STATE_CODES[car.state], car.exited_parking, car.departure_step,
+                      -1 if car.arrival_step is None else car.arrival_step)
+                     for car in model.cars_list], dtype=CHECKPOINT_CAR)
+
+    semaphores = sorted(model.semaphores.items())
+    # Map ids, as restore_semaphores looks them up: unique_id is mesa's own counter
+    map_ids = {semaphore: semaphore_id for semaphore_id, semaphore in semaphores}
+    semaphore_rows = np.array([(semaphore_id, LIGHT_CODES[semaphore.light_state], semaphore.step_counter)
+                               for semaphore_id, semaphore in semaphores], dtype=CHECKPOINT_SEMAPHORE)
+    members = lambda key: np.array([(semaphore_id, car_id) for semaphore_id, semaphore in semaphores
+                                    for car_id in sorted(getattr(semaphore, key))], dtype=np.int64).reshape(-1, 2)
+    queues = np.array([(*point, i, *target) for point, queue in model.spawn_queues.items() for i, target in queue],
+                      dtype=np.int64).reshape(-1, 5)
+
+    routes = model.routes
+    grids = routes.current() if routes is not None else None
+    # Slots 0 .. len(slots) - 1 are in use, in the order of destinations
+    destinations = grids.destinations[:len(grids.slots)] if grids is not None else []
+    route_arrays = {
+        "route_destinations": np.array(destinations, dtype=np.int64).reshape(-1, 2),
+        "route_hops": grids.rows[:len(destinations)] if grids is not None else np.zeros((0, 0), dtype=np.uint8),
+    }
+
+    version, state, gauss = model.random.getstate()
+    meta = {
+        "version": CHECKPOINT_VERSION, "map_name": model.city_map.name,
+        "cars": model.num_cars, "spawn": model.spawn,
+        "target_weights": None if model.target_weights is None else [float(w) for w in model.target_weights],
+        "engine": "agents" if model.batch is None else "batch", "routing": routes is not None,
+        "semaphore_policy": model.semaphore_policy, "green_duration": model.green_duration,
+        "red_duration": model.red_duration,
+        "steps": model.steps, "running": model.running, "map_version": model.map_version,
+        "pending_spawns": model.pending_spawns, "semaphore_evaluations": model.semaphore_evaluations,
+        "last_semaphore_evaluations": model.last_semaphore_evaluations,
+        "random_version": version, "random_gauss": gauss, "numpy_rng": model.rng.bit_generator.state,
+    }
+    np.savez_compressed(
+        path, meta=np.array(json.dumps(meta)), random_state=np.array(state, dtype=np.int64),
+        layer=model.grid.properties["city_objects"].data, cars=cars,
+        active=np.array([car.unique_id for car in model.active_cars], dtype=np.int64),
+        semaphores=semaphore_rows, waiting=members("waiting_cars"), in_range=members("cars_in_range"),
+        dirty=np.array(sorted(map_ids[semaphore] for semaphore in model.dirty_semaphores), dtype=np.int64),
+        queues=queues, entries=np.array(getattr(model, "entry_points", []), dtype=np.int64).reshape(-1, 2),
+        **route_arrays, **map_arrays(model.city_map, prefix="map_"))
+
+
+def load_checkpoint(path, events=None):
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta["version"] != CHECKPOINT_VERSION:
+            raise ValueError(f"{path}: checkpoint version {meta['version']}, expected {CHECKPOINT_VERSION}.")
+        model = CityModel.__new__(CityModel)
+        mesa.Model.__init__(model)
+        model.random.setstate((meta["random_version"], tuple(data["random_state"].tolist()), meta["random_gauss"]))
+        model.rng.bit_generator.state = meta["numpy_rng"]
+        restore_settings(model, meta, events)
+        restore_map(model, map_from_arrays(data, name=meta["map_name"], prefix="map_"), data["layer"])
+        restore_semaphores(model, data)
+        restore_routes(model, meta, data)
+        restore_cars(model, data)
+        if model.spawn:
+            points = model.parking_lots + [tuple(point) for point in data["entries"].tolist()]
+            model.entry_points = points[len(model.parking_lots):]
+            model.spawn_queues = {point: deque() for point in points}
+            for x, y, i, target_x, target_y in data["queues"].tolist():
+                model.spawn_queues[(x, y)].append((i, (target_x, target_y)))
+            model.initialize_spawn_capacity()
+
+    model.steps = meta["steps"]
+    model.running = meta["running"]
+    if meta["engine"] == "batch":
+        from batch import BatchEngine
+        model.batch = BatchEngine(model)
+    return model
+
+
+def restore_settings(model, meta, events):
+    """The attributes CityModel.__init__ sets from its arguments and counters."""
+    model.profiler = None
+    model.semaphore_policy = meta["semaphore_policy"]
+    model.green_duration = meta["green_duration"]
+    model.red_duration = meta["red_duration"]
+    model.events = events if events is not None else NullSink()
+    model.num_cars = meta["cars"]
+    model.cars_list = []
+    model.state_counts = dict.fromkeys(STATE_NAMES, 0)
+    model.cars_by_id = {}
+    model.spawn = meta["spawn"]
+    model.target_weights = meta["target_weights"]
+    model.spawn_queues = {}
+    model.pending_spawns = meta["pending_spawns"]
+    model.active_cars = AgentSet([], random=model.random)
+    model.map_version = meta["map_version"]
+    model.semaphore_evaluations = meta["semaphore_evaluations"]
+    model.last_semaphore_evaluations = meta["last_semaphore_evaluations"]
+    model.snapshot_storage = None
+    model.publisher = None
+    model.recorder = None
+    model.batch = None
+
+
+def restore_map(model, city_map, layer):
+    model.city_map = city_map
+    model.grid = mesa.space.MultiGrid(city_map.width, city_map.height, False)
+    city_objects = mesa.space.PropertyLayer("city_objects", city_map.width, city_map.height, np.int64(0), np.int64)
+    city_objects.data[:] = layer
+    model.grid.properties["city_objects"] = city_objects
+    model.parking_lots = list(city_map.parking_lots)
+    model.parking_lot_map = dict(enumerate(model.parking_lots, start=1))
+    model.parking_lot_cells = set(model.parking_lots)
+    model.roundabout_cells = list(city_map.roundabout_cells)
+    model.lane_directions = city_map.lanes
+    model.occupancy = np.zeros((city_map.width, city_map.height), dtype=np.int32)
+    model.initialize_target_weights()
+
+
+def restore_semaphores(model, data):
+    model.semaphores = {}
+    for semaphore_id, light, step_counter in data["semaphores"].tolist():
+        spec = model.city_map.semaphores[semaphore_id]
+        semaphore = SemaphoreAgent(unique_id=semaphore_id, model=model, positions=list(spec.positions),
+                                   green_duration=model.green_duration, red_duration=model.red_duration,
+                                   paired_semaphore=spec.paired, range_cells=list(spec.range_cells))
+        semaphore.light_state = LIGHT_NAMES[light]
+        semaphore.step_counter = step_counter
+        model.semaphores[semaphore_id] = semaphore
+        model.grid.place_agent(semaphore, semaphore.positions[0])
+    for key, rows in (("waiting_cars", data["waiting"]), ("cars_in_range", data["in_range"])):
+        for semaphore_id, car_id in rows.tolist():
+            getattr(model.semaphores[semaphore_id], key).add(car_id)
+
+    model.semaphore_index = {}
+    for semaphore_id, semaphore in model.semaphores.items():
+        semaphore.controller = model.semaphores[max(semaphore_id, semaphore.paired_semaphore)]
+        for cell in semaphore.range_cells:
+            model.semaphore_index.setdefault(cell, []).append(semaphore)
+    model.semaphore_controllers = sorted({semaphore.controller for semaphore in model.semaphores.values()},
+                                         key=lambda semaphore: semaphore.unique_id)
+    model.dirty_semaphores = {model.semaphores[semaphore_id] for semaphore_id in data["dirty"].tolist()}
+
+
+def restore_routes(model, meta, data):
+    model.routes = None
+    if not meta["routing"]:
+        return
+    from routing import RouteTable
+    routes = model.routes = RouteTable(model)
+    grids = routes.current()
+    with grids.lock:
+        for destination, hops in zip(data["route_destinations"].tolist(), data["route_hops"]):
+            grids.store(tuple(destination), hops)
+
+
+def restore_cars(model, data):
+    cars = data["cars"]
+    for row in cars.tolist():
+        (unique_id, start_x, start_y, x, y, last_x, last_y, target_x, target_y, direction, state, exited,
+         departure_step, arrival_step) = row
+        car = Car(unique_id=unique_id, start_parking=(start_x, start_y), target_parking=(target_x, target_y), model=model)
+        car.state = STATE_NAMES[state]
+        car.direction = DIRECTION_NAMES[direction]
+        car.last_pos = (last_x, last_y) if last_x >= 0 else None
+        car.exited_parking = exited
+        car.departure_step = departure_step
+        car.arrival_step = arrival_step if arrival_step >= 0 else None
+        model.cars_list.append(car)
+        model.cars_by_id[-unique_id] = car
+        model.grid.place_agent(car, (x, y))
+        if not (model.spawn and car.state == "arrived"):
+            model.occupancy[x, y] += 1
+    model.active_cars = AgentSet([model.cars_by_id[-unique_id] for unique_id in data["active"].tolist()],
+                                 random=model.random)
@@ -0,0 +1,217 @@
+"""City maps: the static layout a CityModel is built from, loaded from ASCII or NPZ files.
+
+A CityMap holds the base city_objects values (0 road, 20 building, 21 roundabout, parking
+lot ids; lights are painted by the semaphores), the lane table, the parking lots in id
+order and the semaphore definitions. CityModel(city_map=...) copies the arrays straight
+into its PropertyLayer and lane table; without one it uses maps/city24.txt.
+
+ASCII format (x is the line, y the column, so DOWN is down the page):
+
+    # comment
+    size 24 24
+    objects                     one line per x: '.' road, '#' building, 'P' parking, 'O' roundabout
+    ..##P...
+    lanes                       one line per x: hex lane bits (1 down, 2 up, 4 left, 8 right), '.' none
+    11..0...
+    parking 9,2 2,3 17,3        parking lot ids in order (default: 'P' cells row by row)
+    semaphore 1 pair 2 lights 18,2 19,2 range 18,1 19,1 18,2 19,2
+
+NPZ format (save_npz / load_npz): objects, lanes, parking (P x 2), semaphores (S x 2: id,
+pair), lights and ranges (N x 3: semaphore id, x, y).
+"""
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+ROAD = 0
+BUILDING = 20
+ROUNDABOUT = 21
+# Values the model reserves on city_objects (lights 18/19/25, building, roundabout); parking ids skip them
+RESERVED = range(18, 26)
+
+MAPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps")
+DEFAULT_MAP = os.path.join(MAPS_DIR, "city24.txt")
+
+# 'P' cells get their parking id once the order is known
+PARKING_CELL = -2
+OBJECT_CHARS = {".": ROAD, "#": BUILDING, "O": ROUNDABOUT, "P": PARKING_CELL}
+LANE_CHARS = {".": 0, **{digit: value for value, digit in enumerate("0123456789abcdef")}}
+INVALID = -100
+
+SemaphoreSpec = namedtuple("SemaphoreSpec", ["positions", "paired", "range_cells"])
+
+
+def parking_value(parking_id):
+    """city_objects value of parking lot parking_id (1, 2, ...), skipping the reserved codes."""
+    return parking_id if parking_id < RESERVED.start else parking_id + len(RESERVED)
+
+
+class CityMap:
+    """Static layout of a city."""
+
+    def __init__(self, objects, lanes, parking_lots, semaphores, name=None):
+        self.objects = np.asarray(objects, dtype=np.int64)
+        self.lanes = np.asarray(lanes, dtype=np.uint8)
+        if self.objects.shape != self.lanes.shape:
+            raise ValueError(f"objects {self.objects.shape} and lanes {self.lanes.shape} differ in shape.")
+        self.width, self.height = self.objects.shape
+        self.parking_lots = [tuple(map(int, lot)) for lot in parking_lots]
+        self.semaphores = semaphores
+        self.name = name
+        self.objects.setflags(write=False)
+        self.lanes.setflags(write=False)
+        xs, ys = np.nonzero(self.objects == ROUNDABOUT)
+        self.roundabout_cells = list(zip(xs.tolist(), ys.tolist()))
+
+
+def parse_cells(tokens):
+    return [tuple(int(value) for value in token.split(",")) for token in tokens]
+
+
+def load_ascii(path):
+    with open(path, encoding="utf-8") as file:
+        lines = [line.rstrip("\n") for line in file if line.strip() and not line.startswith("#")]
+
+    width = height = None
+    objects = lanes = None
+    parking_lots = None
+    semaphores = {}
+    i = 0
+    while i < len(lines):
+        words = lines[i].split()
+        if words[0] == "size":
+            width, height = int(words[1]), int(words[2])
+        elif words[0] in ("objects", "lanes"):
+            if width is None:
+                raise ValueError(f"{path}: 'size' must come before the {words[0]} grid.")
+            rows = lines[i + 1:i + 1 + width]
+            if len(rows) != width or any(len(row) != height for row in rows):
+                raise ValueError(f"{path}: the {words[0]} grid must be {width} lines of {height} characters.")
+            grid = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(width, height)
+            if words[0] == "objects":
+                objects = decode(grid, OBJECT_CHARS, path, "objects")
+            else:
+                lanes = decode(grid, LANE_CHARS, path, "lanes")
+            i += width
+        elif words[0] == "parking":
+            parking_lots = parse_cells(words[1:])
+        elif words[0] == "semaphore":
+            fields = {"pair": [], "lights": [], "range": []}
+            key = None
+            for word in words[2:]:
+                if word in fields:
+                    key = word
+                else:
+                    fields[key].append(word)
+            semaphores[int(words[1])] = SemaphoreSpec(parse_cells(fields["lights"]), int(fields["pair"][0]),
+                                                      parse_cells(fields["range"]))
+        else:
+            raise ValueError(f"{path}: unknown directive {words[0]!r}.")
+        i += 1
+
+    if objects is None or lanes is None:
+        raise ValueError(f"{path}: needs both an objects and a lanes grid.")
+    xs, ys = np.nonzero(objects == PARKING_CELL)
+    marked = list(zip(xs.tolist(), ys.tolist()))
+    if parking_lots is None:
+        parking_lots = marked
+    elif sorted(parking_lots) != marked:
+        raise ValueError(f"{path}: the parking line doesn't list exactly the 'P' cells.")
+    set_parking(objects, parking_lots)
+    return CityMap(objects, lanes, parking_lots, semaphores, name=os.path.basename(path))
+
+
+def decode(grid, chars, path, section):
+    table = np.full(256, INVALID, dtype=np.int64)
+    for char, value in chars.items():
+        table[ord(char)] = value
+    values = table[grid]
+    bad = values == INVALID
+    if bad.any():
+        x, y = np.argwhere(bad)[0]
+        raise ValueError(f"{path}: unexpected character {chr(grid[x, y])!r} at {x},{y} in the {section} grid.")
+    return values
+
+
+def set_parking(objects, parking_lots):
+    if parking_lots:
+        xs, ys = np.array(parking_lots).T
+        objects[xs, ys] = [parking_value(parking_id) for parking_id in range(1, len(parking_lots) + 1)]
+
+
+def save_ascii(city_map, path):
+    objects = np.full(city_map.objects.shape, ".", dtype="U1")
+    objects[city_map.objects == BUILDING] = "#"
+    objects[city_map.objects == ROUNDABOUT] = "O"
+    for x, y in city_map.parking_lots:
+        objects[x, y] = "P"
+    lanes = np.array(list(LANE_CHARS)[1:])[city_map.lanes]
+    lanes[city_map.lanes == 0] = "."
+    cells = lambda cells: " ".join(f"{x},{y}" for x, y in cells)
+
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(f"size {city_map.width} {city_map.height}\n")
+        file.write("objects\n")
+        file.writelines("".join(row) + "\n" for row in objects)
+        file.write("lanes\n")
+        file.writelines("".join(row) + "\n" for row in lanes)
+        file.write(f"parking {cells(city_map.parking_lots)}\n")
+        for semaphore_id, spec in city_map.semaphores.items():
+            file.write(f"semaphore {semaphore_id} pair {spec.paired} lights {cells(spec.positions)} "
+                       f"range {cells(spec.range_cells)}\n")
+
+
+def load_npz(path):
+    with np.load(path) as data:
+        return map_from_arrays(data, name=os.path.basename(path))
+
+
+def map_from_arrays(data, name=None, prefix=""):
+    """CityMap from the arrays of map_arrays (data: any mapping, such as an open npz file)."""
+    objects = data[prefix + "objects"].astype(np.int64)
+    parking_lots = [tuple(lot) for lot in data[prefix + "parking"].tolist()]
+    lights = group_cells(data[prefix + "lights"])
+    ranges = group_cells(data[prefix + "ranges"])
+    semaphores = {semaphore_id: SemaphoreSpec(lights.get(semaphore_id, []), paired, ranges.get(semaphore_id, []))
+                  for semaphore_id, paired in data[prefix + "semaphores"].tolist()}
+    return CityMap(objects, data[prefix + "lanes"], parking_lots, semaphores, name=name)
+
+
+def group_cells(rows):
+    """(id, x, y) rows -> {id: [(x, y), ...]}, keeping the row order within each id."""
+    rows = rows[np.argsort(rows[:, 0], kind="stable")]
+    ids, starts = np.unique(rows[:, 0], return_index=True)
+    cells = [tuple(cell) for cell in rows[:, 1:].tolist()]
+    bounds = np.append(starts, len(rows))
+    return {int(group_id): cells[bounds[g]:bounds[g + 1]] for g, group_id in enumerate(ids)}
+
+
+def save_npz(city_map, path):
+    np.savez_compressed(path, **map_arrays(city_map))
+
+
+def map_arrays(city_map, prefix=""):
+    """The NPZ arrays of a map, keyed prefix + name."""
+    rows = lambda key: np.array([(semaphore_id, x, y) for semaphore_id, spec in city_map.semaphores.items()
+                                 for x, y in getattr(spec, key)], dtype=np.int64).reshape(-1, 3)
+    arrays = {"objects": city_map.objects, "lanes": city_map.lanes,
+              "parking": np.array(city_map.parking_lots, dtype=np.int64).reshape(-1, 2),
+              "semaphores": np.array([(semaphore_id, spec.paired) for semaphore_id, spec in city_map.semaphores.items()],
+                                     dtype=np.int64).reshape(-1, 2),
+              "lights": rows("positions"), "ranges": rows("range_cells")}
+    return {prefix + key: value for key, value in arrays.items()}
+
+
+def load_map(path):
+    """CityMap from an .npz file or an ASCII map (any other extension)."""
+    if path.endswith(".npz"):
+        return load_npz(path)
+    return load_ascii(path)
+
+
+@lru_cache(maxsize=None)
+def default_map():
+    """The original 24x24 city, parsed once per process (CityMap arrays are read-only)."""
+    return load_ascii(DEFAULT_MAP)
@@ -0,0 +1,192 @@
+"""Procedural Manhattan-style cities for scale testing, built as CityMap objects.
+
+Streets run the full width and height of the grid and are lane_width cells wide per
+direction; two-way avenues are two opposite one-way corridors side by side (like the
+middle avenues of the 24x24 map). The border streets form a one-way ring (top row to the
+left, left column down, bottom row to the right, right column up), so every street can
+be entered from and left to the ring and the road graph is strongly connected.
+
+Blocks between streets are buildings; building cells on a block's edge become parking
+lots with probability parking_density (never two side by side). Crossings of two avenues can become roundabouts
+(their centre 2x2 cells), and other crossings get a pair of semaphores, one on each
+approach, with a detection range reaching `detection` cells upstream.
+
+    python citygen.py --size 500 --seed 1 -o maps/city500.npz
+
+Everything is drawn from numpy.random.default_rng(seed), so a seed always gives the same map.
+"""
+import argparse
+
+import numpy as np
+
+from Final import DOWN, UP, LEFT, RIGHT
+from city_map import CityMap, SemaphoreSpec, BUILDING, ROUNDABOUT, save_ascii, save_npz, set_parking
+
+
+def layout_streets(size, block, lane_width, two_way_every):
+    """(start cell, corridor count) of each street along one axis; corridor count 2 is a two-way avenue."""
+    def avenues(count):
+        # The border streets stay one-way, they are part of the ring
+        return [two_way_every > 0 and 0 < i < count - 1 and i % two_way_every == 0 for i in range(count)]
+
+    count = max(2, (size - lane_width) // (block + lane_width) + 1)
+    while count > 2 and size - lane_width * (count + sum(avenues(count))) < count - 1:
+        count -= 1
+    two_way = avenues(count)
+    gaps = size - lane_width * (count + sum(two_way))
+    if gaps < count - 1:
+        raise ValueError(f"A {size} cell wide city can't fit two streets of lane_width {lane_width}.")
+    # Spread the leftover cells over the blocks so the streets end on the border
+    blocks = [gaps // (count - 1) + (1 if i < gaps % (count - 1) else 0) for i in range(count - 1)]
+
+    streets = []
+    start = 0
+    for i in range(count):
+        streets.append((start, 2 if two_way[i] else 1))
+        start += lane_width * streets[-1][1] + (blocks[i] if i < count - 1 else 0)
+    return streets
+
+
+def street_headings(streets, forward, backward, one_way, rng):
+    """Heading of each corridor of each street; the first and last street follow the ring."""
+    headings = []
+    last = len(streets) - 1
+    for i, (_, corridors) in enumerate(streets):
+        if corridors == 2:
+            headings.append((forward, backward))
+        elif i == 0:
+            headings.append((forward,))
+        elif i == last:
+            headings.append((backward,))
+        elif one_way == "random":
+            headings.append((forward if rng.random() < 0.5 else backward,))
+        else:
+            headings.append((forward if i % 2 else backward,))
+    return headings
+
+
+def generate_city(width=100, height=100, block=8, lane_width=2, two_way_every=4, one_way="alternating",
+                  parking_density=0.1, roundabout_density=0.5, semaphore_density=0.5, detection=4, seed=None):
+    """Build a CityMap (see the module docstring for the layout rules).
+
+    two_way_every: every n-th inner street is a two-way avenue (0: none, 1: all).
+    one_way: "alternating" (Manhattan) or "random" directions for the one-way streets.
+    """
+    if one_way not in ("alternating", "random"):
+        raise ValueError(f"Unknown one_way pattern {one_way!r}, expected 'alternating' or 'random'.")
+    rng = np.random.default_rng(seed)
+    # rows are streets along y (fixed x), columns are streets along x (fixed y)
+    rows = layout_streets(width, block, lane_width, two_way_every)
+    columns = layout_streets(height, block, lane_width, two_way_every)
+    row_headings = street_headings(rows, LEFT, RIGHT, one_way, rng)
+    column_headings = street_headings(columns, DOWN, UP, one_way, rng)
+
+    lanes = np.zeros((width, height), dtype=np.uint8)
+    for (start, corridors), headings in zip(rows, row_headings):
+        for c in range(corridors):
+            lanes[start + c * lane_width:start + (c + 1) * lane_width, :] |= headings[c]
+    for (start, corridors), headings in zip(columns, column_headings):
+        for c in range(corridors):
+            lanes[:, start + c * lane_width:start + (c + 1) * lane_width] |= headings[c]
+
+    objects = np.where(lanes == 0, BUILDING, 0).astype(np.int64)
+    light_cells = np.zeros((width, height), dtype=bool)
+    semaphores = {}
+    for r, (row_start, row_corridors) in enumerate(rows):
+        for c, (column_start, column_corridors) in enumerate(columns):
+            if row_corridors == 2 and column_corridors == 2 and rng.random() < roundabout_density:
+                cx, cy = row_start + lane_width - 1, column_start + lane_width - 1
+                objects[cx:cx + 2, cy:cy + 2] = ROUNDABOUT
+                continue
+            if rng.random() >= semaphore_density:
+                continue
+            row_end, column_end = row_start + row_corridors * lane_width, column_start + column_corridors * lane_width
+            # The first corridor of each street gets the light, just before the crossing
+            across = approach(row_headings[r][0], column_start, column_end, row_start, lane_width,
+                              columns, c, height, detection, transpose=False)
+            along = approach(column_headings[c][0], row_start, row_end, column_start, lane_width,
+                             rows, r, width, detection, transpose=True)
+            if across is None or along is None:
+                continue
+            first = len(semaphores) + 1
+            semaphores[first] = SemaphoreSpec(across[0], first + 1, across[1])
+            semaphores[first + 1] = SemaphoreSpec(along[0], first, along[1])
+            for x, y in across[0] + along[0]:
+                light_cells[x, y] = True
+
+    # Parking lots: edge cells of the blocks, not next to a light
+    road = objects == 0
+    next_to_road = np.zeros_like(road)
+    next_to_light = np.zeros_like(road)
+    for grid, out in ((road, next_to_road), (light_cells, next_to_light)):
+        out[1:, :] |= grid[:-1, :]
+        out[:-1, :] |= grid[1:, :]
+        out[:, 1:] |= grid[:, :-1]
+        out[:, :-1] |= grid[:, 1:]
+    candidates = (objects == BUILDING) & next_to_road & ~next_to_light
+    drawn = candidates & (rng.random((width, height)) < parking_density)
+    # No two lots side by side: a car leaving a lot must land on the road, not in an emptied neighbour lot
+    lots = drawn.copy()
+    lots[1:, :] &= ~drawn[:-1, :]
+    lots[:, 1:] &= ~drawn[:, :-1]
+    xs, ys = np.nonzero(lots)
+    parking_lots = list(zip(xs.tolist(), ys.tolist()))
+    set_parking(objects, parking_lots)
+
+    name = f"citygen-{width}x{height}-seed{seed}"
+    return CityMap(objects, lanes, parking_lots, semaphores, name=name)
+
+
+def approach(heading, crossing_start, crossing_end, corridor_start, lane_width, crossings, index, size, detection,
+             transpose):
+    """Light cells and detection range of the corridor at corridor_start entering a crossing, or None at the border.
+
+    The corridor runs along the axis of the crossing streets; heading is its lane bit.
+    """
+    if heading in (LEFT, UP):
+        light = crossing_end
+        limit = crossings[index + 1][0] - 1 if index + 1 < len(crossings) else size - 1
+        upstream = range(light, min(light + detection, limit + 1))
+    else:
+        light = crossing_start - 1
+        limit = crossings[index - 1][0] + crossings[index - 1][1] * lane_width if index > 0 else 0
+        upstream = range(light, max(light - detection, limit - 1), -1)
+    if light < 0 or light >= size or not len(upstream):
+        return None
+    corridor = range(corridor_start, corridor_start + lane_width)
+    lights = [(a, light) for a in corridor]
+    ranges = [(a, b) for b in upstream for a in corridor]
+    if transpose:
+        lights = [(b, a) for a, b in lights]
+        ranges = [(b, a) for a, b in ranges]
+    return lights, ranges
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a Manhattan-style city map.")
+    parser.add_argument("--size", type=int, default=100, help="width and height in cells")
+    parser.add_argument("--block", type=int, default=8, help="block size in cells")
+    parser.add_argument("--lane-width", type=int, default=2)
+    parser.add_argument("--two-way-every", type=int, default=4)
+    parser.add_argument("--one-way", default="alternating", choices=("alternating", "random"))
+    parser.add_argument("--parking-density", type=float, default=0.1)
+    parser.add_argument("--roundabout-density", type=float, default=0.5)
+    parser.add_argument("--semaphore-density", type=float, default=0.5)
+    parser.add_argument("--detection", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", required=True, help=".npz or ASCII (any other extension) file")
+    args = parser.parse_args()
+
+    city_map = generate_city(args.size, args.size, args.block, args.lane_width, args.two_way_every, args.one_way,
+                             args.parking_density, args.roundabout_density, args.semaphore_density, args.detection,
+                             args.seed)
+    if args.output.endswith(".npz"):
+        save_npz(city_map, args.output)
+    else:
+        save_ascii(city_map, args.output)
+    print(f"{city_map.width}x{city_map.height}: {len(city_map.parking_lots)} parking lots, "
+          f"{len(city_map.semaphores)} semaphores, {len(city_map.roundabout_cells) // 4} roundabouts")
+
+
+if __name__ == "__main__":
+    main()
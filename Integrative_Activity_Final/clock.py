@@ -0,0 +1,119 @@
+"""Background simulation clock for the Flask server.
+
+SimulationClock advances a CityModel at a fixed tick rate on a daemon thread. After every
+tick it builds a snapshot with the given function and swaps it in as the latest one, so
+readers never touch the model and never wait for a tick in progress.
+
+Push subscribers (the /stream endpoint) each get a FrameSlot that only holds the newest
+snapshot: a slow client skips intermediate ticks instead of queueing them in memory.
+"""
+import threading
+import time
+
+
+class FrameSlot:
+    """Single-frame mailbox of one subscriber; a new frame replaces an unread one."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.dropped = 0
+        self.closed = False
+
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+
+    def get(self, timeout=None):
+        """Newest unread frame, or None after timeout or once the slot is closed."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None or self.closed, timeout)
+            frame, self.frame = self.frame, None
+            return frame
+
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class SimulationClock:
+    """Steps a model tick_rate times per second and publishes a snapshot after each tick."""
+
+    def __init__(self, model, tick_rate, snapshot):
+        self.model = model
+        self.interval = 1.0 / tick_rate
+        self.make_snapshot = snapshot
+        # Serialises model access between the clock and anything else that steps it
+        self.lock = threading.Lock()
+        self.snapshot = snapshot(model)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.subscribers = set()
+        # Set under lock once run() has closed its subscribers; later subscribers get a closed slot
+        self.closed = False
+
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # Restarting after stop(): tick again and take new subscribers
+                self.stopped.clear()
+                self.closed = False
+                self.thread = threading.Thread(target=self.run, name="simulation-clock", daemon=True)
+                self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def subscribe(self):
+        slot = FrameSlot()
+        with self.lock:
+            if self.closed:
+                slot.close()
+            else:
+                self.subscribers.add(slot)
+        slot.put(self.snapshot)
+        return slot
+
+
+    def unsubscribe(self, slot):
+        with self.lock:
+            self.subscribers.discard(slot)
+
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stopped.is_set() and self.model.running:
+            with self.lock:
+                self.model.step()
+                snapshot = self.make_snapshot(self.model)
+                subscribers = list(self.subscribers)
+            # Replacing the reference is atomic, readers see either the old or the new snapshot
+            self.snapshot = snapshot
+            for slot in subscribers:
+                slot.put(snapshot)
+
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+            else:
+                # Running behind: don't try to catch up with a burst of ticks
+                next_tick = time.monotonic()
+
+        with self.lock:
+            self.closed = True
+            for slot in self.subscribers:
+                slot.close()
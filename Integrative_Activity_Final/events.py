@@ -0,0 +1,97 @@
+"""Event sinks for the city simulation.
+
+The model only builds an event when the sink's level lets it through, so with the
+default NullSink the hot path does no string formatting at all:
+
+    events = self.model.events
+    if events.level <= DEBUG:
+        events.emit(DEBUG, "car_moved", step=self.model.steps, car=self.unique_id, to=new_position)
+"""
+import json
+from collections import deque
+
+import numpy as np
+
+TRACE = 5       # per-tick grid dumps and neighbourhood details
+DEBUG = 10      # every agent action
+INFO = 20       # car creation, arrivals, end of simulation
+WARNING = 30
+OFF = 100
+
+LEVEL_NAMES = {TRACE: "TRACE", DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", OFF: "OFF"}
+
+
+class NullSink:
+    """Discards everything. Default sink of CityModel."""
+
+    level = OFF
+
+    def emit(self, level, event, **fields):
+        pass
+
+    def close(self):
+        pass
+
+
+class RingBufferSink:
+    """Keeps the last `capacity` events in memory as (level, event, fields) tuples."""
+
+    def __init__(self, capacity=10000, level=DEBUG):
+        self.level = level
+        self.events = deque(maxlen=capacity)
+
+    def emit(self, level, event, **fields):
+        if level >= self.level:
+            self.events.append((level, event, fields))
+
+    def clear(self):
+        self.events.clear()
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """Appends one JSON object per event to a file."""
+
+    def __init__(self, path, level=INFO):
+        self.level = level
+        self.file = open(path, "a", encoding="utf-8")
+
+    def emit(self, level, event, **fields):
+        if level >= self.level:
+            record = {"level": LEVEL_NAMES.get(level, level), "event": event}
+            record.update(fields)
+            self.file.write(json.dumps(record, default=_to_json))
+            self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+class PrintSink:
+    """Prints events to stdout, for interactive debugging."""
+
+    def __init__(self, level=DEBUG):
+        self.level = level
+
+    def emit(self, level, event, **fields):
+        if level >= self.level:
+            details = " ".join(f"{key}={value}" for key, value in fields.items() if not isinstance(value, np.ndarray))
+            print(f"[{LEVEL_NAMES.get(level, level)}] {event} {details}")
+            for value in fields.values():
+                if isinstance(value, np.ndarray):
+                    print(value)
+
+    def close(self):
+        pass
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,78 @@
+"""Opt-in wall-time profiling of CityModel.step and the agent methods it calls.
+
+Profiling is off unless the model has a PhaseProfiler (CityModel(profile=True), or
+model.enable_profiling() at any time). It is per model: the @profiled agent methods and
+CityModel.step check their own model's profiler, so a model that doesn't profile pays one
+attribute check per call whatever the other models in the process do:
+
+    model = CityModel(cars=17, profile=True)
+    for _ in range(50):
+        model.step()
+    model.profiler.report()
+    # {"phase.agents": {"calls": 50, "total_ms": 4.1, "mean_us": 82.3}, "car.move": {...}, ...}
+
+Phase timings ("phase.*") partition a tick; method timings ("car.*", "semaphore.*") are
+inclusive, so car.move contains the car.is_valid_step calls it makes.
+"""
+import functools
+import time
+from collections import defaultdict
+
+clock = time.perf_counter_ns
+
+
+class PhaseProfiler:
+    """Accumulated wall time (ns) and call counts per phase or method name."""
+
+    def __init__(self):
+        self.totals = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.last = 0
+
+
+    def record(self, name, elapsed):
+        self.totals[name] += elapsed
+        self.counts[name] += 1
+
+
+    def start(self):
+        """Mark the beginning of a tick; each lap() then records the time since the previous mark."""
+        self.last = clock()
+
+
+    def lap(self, name):
+        now = clock()
+        self.totals[name] += now - self.last
+        self.counts[name] += 1
+        self.last = now
+
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+
+
+    def report(self):
+        """{name: {"calls", "total_ms", "mean_us"}} sorted by total time, highest first."""
+        names = sorted(self.totals, key=self.totals.get, reverse=True)
+        return {name: {"calls": self.counts[name],
+                       "total_ms": self.totals[name] / 1e6,
+                       "mean_us": self.totals[name] / self.counts[name] / 1e3}
+                for name in names}
+
+
+def profiled(name):
+    """Time a method of an agent under name whenever its model has a profiler."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.model.profiler
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            started = clock()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profiler.record(name, clock() - started)
+        return wrapper
+    return decorate
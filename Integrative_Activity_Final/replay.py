@@ -0,0 +1,211 @@
+"""Append-only replay logs of a CityModel run, and random access to any recorded tick.
+
+model.record_replay(path) (or ReplayRecorder) appends the model's current tick and then
+every finished tick to path. An existing log is continued, as long as its header matches
+the model (map size, fleet, semaphores, keyframe interval) and its last tick is earlier
+than the model's, e.g. for a run resumed from a checkpoint. Each tick is stored as what changed since the previous one:
+the car records (CAR_RECORD: id, x, y, heading, state) of the cars that moved or changed
+state, the semaphores whose light changed, and the city_objects cells that changed. Every
+keyframe_every ticks a keyframe with the full state is written instead, so ReplayReader
+rebuilds any tick from the closest keyframe plus at most keyframe_every - 1 deltas:
+
+    reader = ReplayReader("run.replay")
+    state = reader.state_at(1234)          # ReplayState(tick, cars, semaphores, layer)
+    for state in reader.states(1000, 1100):
+        ...
+
+File layout (little-endian, packed): a REPLAY_HEADER, then one record per tick, each a
+RECORD_HEADER followed by its car records, semaphore records and cells. A keyframe's
+cells are the whole layer as int32; a delta's are the flat indices (x * height + y, u32)
+followed by their new values (i32). A record cut short by a crash is ignored on reading.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from Final import CAR_RECORD, SEMAPHORE_RECORD, parse_snapshot
+
+REPLAY_MAGIC = b"CRPL"
+REPLAY_VERSION = 1
+REPLAY_HEADER = np.dtype([("magic", "S4"), ("version", "<u2"), ("width", "<u4"), ("height", "<u4"),
+                          ("cars", "<u4"), ("semaphores", "<u4"), ("keyframe_every", "<u4")])
+RECORD_HEADER = np.dtype([("keyframe", "u1"), ("tick", "<u4"), ("cars", "<u4"), ("semaphores", "<u4"),
+                          ("cells", "<u4")])
+
+ReplayState = namedtuple("ReplayState", ["tick", "cars", "semaphores", "layer"])
+
+
+class ReplayRecorder:
+    """Writes the ticks of a model to a replay log; the model calls record() after each step."""
+
+    def __init__(self, model, path, keyframe_every=100):
+        self.model = model
+        self.keyframe_every = keyframe_every
+        self.layer = model.grid.properties["city_objects"].data
+        self.previous_layer = self.layer.copy()
+        self.previous_cars = np.zeros(model.num_cars, dtype=CAR_RECORD)
+        self.previous_lights = None
+        self.ticks = 0
+        header = np.zeros(1, dtype=REPLAY_HEADER)
+        header["magic"] = REPLAY_MAGIC
+        header["version"] = REPLAY_VERSION
+        header["width"], header["height"] = self.layer.shape
+        header["cars"] = model.num_cars
+        header["semaphores"] = len(model.semaphores)
+        header["keyframe_every"] = keyframe_every
+        self.file = open(path, "ab")
+        if self.file.tell():
+            self.resume(path, header[0])
+        else:
+            self.file.write(header.tobytes())
+        # The first record is a keyframe, appended or not
+        self.record()
+
+
+    def resume(self, path, header):
+        """Check that the log at path can take this model's ticks; drops a record a crash cut short."""
+        log = ReplayReader(path)
+        if log.header != header:
+            self.file.close()
+            raise ValueError(f"{path}: replay log of another map, fleet or keyframe interval.")
+        if log.ticks.size and log.ticks[-1] >= self.model.steps:
+            self.file.close()
+            raise ValueError(f"{path}: log already goes up to tick {log.ticks[-1]}, model is at {self.model.steps}.")
+        end = log.end
+        del log
+        self.file.truncate(end)
+
+
+    def record(self):
+        tick, semaphores, cars = parse_snapshot(self.model.snapshot_buffer())
+        slots = -cars["id"].astype(np.int64) - 1
+        keyframe = self.ticks % self.keyframe_every == 0
+        if keyframe:
+            changed_cars, changed_semaphores = cars, semaphores
+            cells = self.layer.astype(np.int32)
+        else:
+            changed_cars = cars[cars != self.previous_cars[slots]]
+            changed_semaphores = semaphores[semaphores["light"] != self.previous_lights]
+            flat = np.flatnonzero(self.layer != self.previous_layer)
+            cells = np.concatenate([flat.astype(np.uint32).view(np.int32), self.layer.reshape(-1)[flat].astype(np.int32)])
+
+        header = np.zeros(1, dtype=RECORD_HEADER)
+        header["keyframe"] = keyframe
+        header["tick"] = tick
+        header["cars"] = changed_cars.size
+        header["semaphores"] = changed_semaphores.size
+        header["cells"] = self.layer.size if keyframe else cells.size // 2
+        self.file.write(header.tobytes() + changed_cars.tobytes() + changed_semaphores.tobytes() + cells.tobytes())
+        if keyframe:
+            self.file.flush()
+
+        self.previous_cars[slots] = cars
+        self.previous_lights = semaphores["light"].copy()
+        self.previous_layer[:] = self.layer
+        self.ticks += 1
+
+
+    def close(self):
+        if self.model.recorder is self:
+            self.model.recorder = None
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayReader:
+    """Random access to the ticks of a replay log (memory-mapped, indexed on open)."""
+
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, np.uint8)
+        if self.data.size < REPLAY_HEADER.itemsize:
+            raise ValueError(f"{path}: not a replay log.")
+        header = self.header = self.data[:REPLAY_HEADER.itemsize].view(REPLAY_HEADER)[0]
+        if header["magic"] != REPLAY_MAGIC or header["version"] != REPLAY_VERSION:
+            raise ValueError(f"{path}: not a version {REPLAY_VERSION} replay log.")
+        self.width, self.height = int(header["width"]), int(header["height"])
+        self.capacity = int(header["cars"])
+        self.keyframe_every = int(header["keyframe_every"])
+        self.index()
+
+
+    def index(self):
+        """Offsets of every complete record, which of them are keyframes, and where the last one ends."""
+        ticks, offsets, keyframes = [], [], []
+        offset = REPLAY_HEADER.itemsize
+        end = self.data.size
+        while offset + RECORD_HEADER.itemsize <= end:
+            header = self.data[offset:offset + RECORD_HEADER.itemsize].view(RECORD_HEADER)[0]
+            cells = int(header["cells"]) * (4 if header["keyframe"] else 8)
+            size = (RECORD_HEADER.itemsize + int(header["cars"]) * CAR_RECORD.itemsize
+                    + int(header["semaphores"]) * SEMAPHORE_RECORD.itemsize + cells)
+            if offset + size > end:
+                break
+            ticks.append(int(header["tick"]))
+            offsets.append(offset)
+            keyframes.append(bool(header["keyframe"]))
+            offset += size
+        self.ticks = np.array(ticks, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.keyframes = np.flatnonzero(keyframes)
+        self.end = offset
+
+
+    def record(self, r):
+        """(is keyframe, car records, semaphore records, cells) of record number r."""
+        offset = int(self.offsets[r])
+        header = self.data[offset:offset + RECORD_HEADER.itemsize].view(RECORD_HEADER)[0]
+        offset += RECORD_HEADER.itemsize
+        end = offset + int(header["cars"]) * CAR_RECORD.itemsize
+        cars = self.data[offset:end].view(CAR_RECORD)
+        offset, end = end, end + int(header["semaphores"]) * SEMAPHORE_RECORD.itemsize
+        semaphores = self.data[offset:end].view(SEMAPHORE_RECORD)
+        cells = self.data[end:end + int(header["cells"]) * (4 if header["keyframe"] else 8)].view(np.int32)
+        return bool(header["keyframe"]), cars, semaphores, cells
+
+
+    def state_at(self, tick):
+        """ReplayState of a recorded tick (KeyError if it isn't in the log)."""
+        r = int(np.searchsorted(self.ticks, tick))
+        if r == self.ticks.size or self.ticks[r] != tick:
+            raise KeyError(tick)
+        return next(self.states(tick, tick + 1))
+
+
+    def states(self, start=None, stop=None):
+        """ReplayState of every recorded tick with start <= tick < stop, in order.
+
+        Consecutive states share their arrays, which are only valid until the next one.
+        """
+        first = 0 if start is None else int(np.searchsorted(self.ticks, start))
+        last = self.ticks.size if stop is None else int(np.searchsorted(self.ticks, stop))
+        if first >= last:
+            return
+        keyframe = self.keyframes[np.searchsorted(self.keyframes, first, side="right") - 1]
+
+        cars = np.zeros(self.capacity, dtype=CAR_RECORD)
+        present = np.zeros(self.capacity, dtype=bool)
+        layer = np.zeros((self.width, self.height), dtype=np.int32)
+        flat_layer = layer.reshape(-1)
+        semaphores = None
+        for r in range(keyframe, last):
+            is_keyframe, changed_cars, changed_semaphores, cells = self.record(r)
+            slots = -changed_cars["id"].astype(np.int64) - 1
+            cars[slots] = changed_cars
+            present[slots] = True
+            if is_keyframe:
+                semaphores = changed_semaphores.copy()
+                flat_layer[:] = cells
+            else:
+                semaphores["light"][np.searchsorted(semaphores["id"], changed_semaphores["id"])] = changed_semaphores["light"]
+                count = cells.size // 2
+                flat_layer[cells[:count].view(np.uint32)] = cells[count:]
+            if r >= first:
+                yield ReplayState(int(self.ticks[r]), cars[present], semaphores, layer)
@@ -0,0 +1,275 @@
+"""Shortest-path routing over the one-way lane graph of a CityModel.
+
+A car may step from u to a neighbouring road cell v when the lane table of v allows the
+heading u -> v (the static part of Car.is_valid_step). A parking lot is entered from any
+adjacent road cell and left to any adjacent road cell.
+
+The next hops live in a HopGrids cache, one per lane table and set of lots, shared by
+every model (and in-process shard worker) built on the same map. A destination's hops are
+only computed the first time a car needs them, by one breadth-first search
+(scipy.sparse.csgraph) backwards from the destination over the reversed steps: the cell a
+search reaches another from is that cell's next hop. Destinations are road cells or lots.
+
+Each destination takes one row of at most max_bytes of storage (ROUTE_CACHE_BYTES by
+default), 4 bits per routable cell (road cells and lots, where cars stand); once the rows
+are full the least recently used destination gives its row up. The batch engine indexes
+the rows by slot, checks HopGrids.owner to notice a slot that went to another destination,
+and never takes a row back from a car routed in the same tick: with more targets on the
+move than rows, the cars left over step without a route until rows free up.
+
+RouteTable keeps a model on the HopGrids of its current lanes and checks
+CityModel.map_version on every lookup, so bumping it after editing the map moves the model
+to a fresh cache.
+"""
+import hashlib
+import threading
+import weakref
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
+
+from Final import NEIGHBOR_OFFSETS, NEIGHBOR_BITS
+
+# Hop code of a cell without a next hop (the destination itself, or no route from there)
+NO_HOP = 15
+# Storage for the rows of one HopGrids: about 4700 destinations of a 500x500 city
+ROUTE_CACHE_BYTES = 256 << 20
+
+# Lane table and lots digest -> HopGrids, alive as long as some RouteTable uses it
+_shared = weakref.WeakValueDictionary()
+_shared_lock = threading.Lock()
+
+
+class HopGrids:
+    """Next hops of one lane table and its lots, as one packed row of routable cells per destination."""
+
+    def __init__(self, lanes, lots, max_bytes=None):
+        self.lanes = lanes.copy()
+        self.width, self.height = lanes.shape
+        self.lock = threading.Lock()
+
+        size = lanes.size
+        road = (self.lanes != 0).reshape(-1)
+        flat_lanes = self.lanes.reshape(-1)
+        x, y = np.divmod(np.arange(size), self.height)
+        lot = np.zeros(size, dtype=bool)
+        lot[[lx * self.height + ly for lx, ly in lots]] = True
+        # Steps u -> v as (u, v) flat cell pairs: from a road cell to a neighbour whose lanes allow
+        # the heading, or to a lot to park in
+        steps, exits = [], []
+        for k, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+            vx, vy = x + dx, y + dy
+            inside = (vx >= 0) & (vx < self.width) & (vy >= 0) & (vy < self.height)
+            v = np.where(inside, vx * self.height + vy, 0)
+            u = np.flatnonzero(inside & road & (lot[v] | (road[v] & ((flat_lanes[v] & NEIGHBOR_BITS[k]) != 0))))
+            steps.append((u, v[u]))
+            # ... and from a lot back to any road neighbour
+            u = np.flatnonzero(inside & lot & road[v])
+            exits.append((u, v[u]))
+
+        # Routable cells get the nodes 0..n-1 of the graph and the packed rows. A lot is only ever
+        # a search's destination, so leaving it is a second node, n + i.
+        self.cells = np.flatnonzero(road | lot)
+        self.index = np.full(size, -1, dtype=np.int64)
+        self.index[self.cells] = np.arange(self.cells.size)
+        lots = self.cells[lot[self.cells]]
+        leaving = np.full(size, -1, dtype=np.int64)
+        leaving[lots] = self.cells.size + np.arange(lots.size)
+        # Node -> routable index and flat cell of its cell
+        self.node_cell = np.concatenate([np.arange(self.cells.size), self.index[lots]]).astype(np.int32)
+        self.node_flat = self.cells[self.node_cell].astype(np.int32)
+        nodes = self.node_cell.size
+
+        u = np.concatenate([self.index[u] for u, _ in steps] + [leaving[u] for u, _ in exits])
+        v = np.concatenate([self.index[v] for _, v in steps] + [self.index[v] for _, v in exits])
+        # The steps reversed (v -> u), so a search from a destination reaches every node that can get there
+        self.reversed_steps = csr_matrix((np.ones(u.size, dtype=np.int8), (v, u)), shape=(nodes, nodes))
+        # A step as the difference of its flat cells, sorted, and the step's index in NEIGHBOR_OFFSETS
+        deltas = np.array([dx * self.height + dy for dx, dy in NEIGHBOR_OFFSETS], dtype=np.int32)
+        self.step_order = np.argsort(deltas).astype(np.uint8)
+        self.step_deltas = deltas[self.step_order]
+
+        self.row_bytes = (self.cells.size + 1) // 2
+        self.capacity = max(1, (ROUTE_CACHE_BYTES if max_bytes is None else max_bytes) // self.row_bytes)
+        # Destination -> slot, and the other way round; owner holds the slot's flat destination cell (-1: free)
+        self.slots = {}
+        self.destinations = []
+        self.rows = np.zeros((0, self.row_bytes), dtype=np.uint8)
+        self.owner = np.zeros(0, dtype=np.int64)
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.uses = 0
+
+
+    @classmethod
+    def shared(cls, lanes, lots):
+        """The HopGrids of this lane table and lots, created on first use."""
+        digest = hashlib.blake2b(np.ascontiguousarray(lanes).tobytes(), digest_size=16)
+        digest.update(np.array(sorted(lots), dtype=np.int64).tobytes())
+        key = (lanes.shape, digest.digest())
+        with _shared_lock:
+            grids = _shared.get(key)
+            if grids is None:
+                grids = _shared[key] = cls(lanes, lots)
+        return grids
+
+
+    def lookup(self, destinations):
+        """Slots of several destinations, searching for the new ones.
+
+        A slot holds its destination until more than capacity other destinations have been
+        used since; check owner before reading a slot kept from an earlier call.
+        """
+        with self.lock:
+            return [self.slot(destination) for destination in destinations]
+
+
+    def slot(self, destination, keep_since=None):
+        """Row holding the destination's next hops, searched for on first use (call under lock).
+
+        Rows used after the keep_since mark (a value of uses) are kept: -1 when they all were.
+        """
+        slot = self.slots.get(destination)
+        if slot is not None:
+            self.touch(slot)
+            return slot
+        if keep_since is not None and len(self.slots) == self.capacity and self.last_used.min() > keep_since:
+            return -1
+        return self.store(destination, self.search(destination))
+
+
+    def touch(self, slots):
+        """Mark slots as just used, so they are the last to be given up."""
+        self.uses += 1
+        self.last_used[slots] = self.uses
+
+
+    def store(self, destination, row):
+        """Keep a packed row for destination, in a fresh slot or the least recently used one."""
+        slot = self.slots.get(destination)
+        if slot is not None:
+            return slot
+        slot = len(self.slots)
+        if slot == self.capacity:
+            slot = int(np.argmin(self.last_used))
+            del self.slots[self.destinations[slot]]
+        elif slot == self.rows.shape[0]:
+            grown = min(self.capacity, max(8, 2 * slot))
+            self.rows = np.concatenate([self.rows, np.zeros((grown - slot, self.row_bytes), dtype=np.uint8)])
+            self.owner = np.concatenate([self.owner, np.full(grown - slot, -1, dtype=np.int64)])
+            self.last_used = np.concatenate([self.last_used, np.zeros(grown - slot, dtype=np.int64)])
+            self.destinations.extend([None] * (grown - slot))
+        self.rows[slot] = row
+        self.slots[destination] = slot
+        self.destinations[slot] = destination
+        self.owner[slot] = destination[0] * self.height + destination[1]
+        self.touch(slot)
+        return slot
+
+
+    def hops(self, slots, flat):
+        """Index in NEIGHBOR_OFFSETS of the next hop from each flat cell, in the row of its slot (-1: none)."""
+        cells = self.index[flat]
+        routable = cells >= 0
+        cells = np.where(routable, cells, 0)
+        codes = (self.rows[slots, cells >> 1] >> ((cells & 1) << 2)) & 0xF
+        return np.where(routable & (codes != NO_HOP), codes, -1).astype(np.int8)
+
+
+    def hop(self, destination, position):
+        """hops() of one cell towards one destination, without the array overhead (the agent path)."""
+        cell = int(self.index[position[0] * self.height + position[1]])
+        if cell < 0:
+            return -1
+        with self.lock:
+            slot = self.slot(destination)
+            code = (int(self.rows[slot, cell >> 1]) >> ((cell & 1) << 2)) & 0xF
+        return -1 if code == NO_HOP else code
+
+
+    def grid(self, destination):
+        """int8 grid holding, per cell, the index in NEIGHBOR_OFFSETS of the next hop (-1: no route)."""
+        grid = np.full(self.lanes.size, -1, dtype=np.int8)
+        with self.lock:
+            slot = self.slot(destination)
+            grid[self.cells] = self.hops(slot, self.cells)
+        return grid.reshape(self.width, self.height)
+
+
+    def search(self, destination):
+        """Packed row of the next hops towards destination, two routable cells per byte.
+
+        A cell's next hop is the step to the node the backwards search reached it from, so one
+        step closer to the destination.
+        """
+        codes = np.full(self.row_bytes * 2, NO_HOP, dtype=np.uint8)
+        target = self.index[destination[0] * self.height + destination[1]]
+        if target >= 0:
+            order, parents = breadth_first_order(self.reversed_steps, target, directed=True,
+                                                 return_predecessors=True)
+            reached = order[1:]
+            parent = parents[reached]
+            delta = self.node_flat[parent] - self.node_flat[reached]
+            codes[self.node_cell[reached]] = self.step_order[np.searchsorted(self.step_deltas, delta)]
+            codes[target] = NO_HOP
+        return codes[0::2] | (codes[1::2] << 4)
+
+
+class RouteTable:
+    """A model's view of the shared next-hop grids, plus its cached full routes."""
+
+    def __init__(self, model):
+        self.model = model
+        self.map_version = None
+        self.grids = None
+        self.routes = {}
+
+
+    def invalidate(self):
+        self.grids = HopGrids.shared(self.model.lane_directions, self.model.parking_lots)
+        self.routes.clear()
+        self.map_version = self.model.map_version
+
+
+    def current(self):
+        """The HopGrids of the model's lanes as of its map_version."""
+        if self.map_version != self.model.map_version:
+            self.invalidate()
+        return self.grids
+
+
+    def hop_grid(self, destination):
+        """int8 grid holding, per cell, the index in NEIGHBOR_OFFSETS of the next hop (-1: no route)."""
+        return self.current().grid(destination)
+
+
+    def next_hop(self, position, destination):
+        """Next cell on a shortest route from position to destination, or None."""
+        k = self.current().hop(destination, position)
+        if k < 0:
+            return None
+        dx, dy = NEIGHBOR_OFFSETS[k]
+        return (position[0] + int(dx), position[1] + int(dy))
+
+
+    def distance(self, position, destination):
+        """Number of steps of the shortest route, or -1 when the destination is unreachable."""
+        path = self.route(position, destination)
+        return -1 if path is None else len(path)
+
+
+    def route(self, origin, destination):
+        """Cells of the shortest route after origin, ending at destination (None if unreachable)."""
+        self.current()
+        key = (origin, destination)
+        if key not in self.routes:
+            path = []
+            position = origin
+            while position != destination:
+                position = self.next_hop(position, destination)
+                if position is None:
+                    path = None
+                    break
+                path.append(position)
+            self.routes[key] = path
+        return self.routes[key]
@@ -0,0 +1,129 @@
+"""Independent CityModel instances hosted side by side, addressed by session id.
+
+SessionManager keeps its sessions in least-recently-used order. Sessions idle for longer
+than idle_timeout are dropped, and creating a session evicts the least recently used
+ones while the session count or the estimated memory would exceed the caps.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from Final import CityModel
+from city_map import default_map
+
+# Rough footprint of a model, measured with tracemalloc on the 24x24 map (per engine: the
+# agent engine's scheduler and semaphore agents outweigh the batch engine's arrays)
+MODEL_BASE_BYTES = {"agents": 256 * 1024, "batch": 128 * 1024}
+CAR_BYTES = 1024
+CELL_BYTES = 16
+
+
+def estimate_model_bytes(width, height, cars, engine="agents"):
+    """Estimated footprint of a CityModel, known before it is built."""
+    base = MODEL_BASE_BYTES.get(engine, MODEL_BASE_BYTES["agents"])
+    return base + CAR_BYTES * cars + CELL_BYTES * width * height
+
+
+class Session:
+    def __init__(self, session_id, model, memory):
+        self.session_id = session_id
+        self.model = model
+        # Held while the model is stepped or read
+        self.lock = threading.Lock()
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.memory = memory
+
+
+class SessionManager:
+    """Creates, steps, snapshots and destroys CityModel sessions."""
+
+    def __init__(self, max_sessions=32, idle_timeout=600, max_memory=512 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        self.sessions = OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+
+
+    def create(self, **params):
+        """Build a CityModel from params (same keywords as CityModel) and return its session id.
+
+        Raises MemoryError, before building anything, when the model alone would exceed max_memory.
+        """
+        city_map = params.get("city_map")
+        if city_map is None:
+            city_map = default_map()
+        memory = estimate_model_bytes(city_map.width, city_map.height, params["cars"], params.get("engine", "agents"))
+        if memory > self.max_memory:
+            raise MemoryError(f"Session needs ~{memory} bytes, more than the {self.max_memory} byte cap.")
+        session = Session(uuid.uuid4().hex, CityModel(**params), memory)
+
+        with self.lock:
+            self.evict_idle()
+            while self.sessions and (len(self.sessions) >= self.max_sessions
+                                     or self.memory + session.memory > self.max_memory):
+                self.remove(next(iter(self.sessions)))
+            self.sessions[session.session_id] = session
+            self.memory += session.memory
+        return session.session_id
+
+
+    def get(self, session_id):
+        """Session by id, marked as most recently used. Raises KeyError if unknown or evicted."""
+        with self.lock:
+            self.evict_idle()
+            session = self.sessions[session_id]
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            return session
+
+
+    def step(self, session_id, steps=1):
+        session = self.get(session_id)
+        with session.lock:
+            for _ in range(steps):
+                if not session.model.running:
+                    break
+                session.model.step()
+            return session.model.steps
+
+
+    def snapshot(self, session_id):
+        """Binary snapshot (see CityModel.snapshot_buffer) of the session's current tick."""
+        session = self.get(session_id)
+        with session.lock:
+            return bytes(session.model.snapshot_buffer())
+
+
+    def destroy(self, session_id):
+        with self.lock:
+            self.remove(session_id)
+
+
+    def list_sessions(self):
+        with self.lock:
+            self.evict_idle()
+            now = time.monotonic()
+            return [{"session_id": session.session_id, "tick": session.model.steps, "cars": session.model.num_cars,
+                     "running": session.model.running, "idle_seconds": now - session.last_used,
+                     "memory": session.memory}
+                    for session in self.sessions.values()]
+
+
+    def evict_idle(self):
+        """Drop sessions unused for idle_timeout seconds. Caller holds self.lock."""
+        deadline = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used > deadline:
+                break
+            self.remove(session.session_id)
+
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.memory -= session.memory
+        session.model.events.close()
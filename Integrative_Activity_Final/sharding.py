@@ -0,0 +1,303 @@
+"""Sharded execution: the city split into strips of rows, each stepped by its own process.
+
+Every shard owns the rows x0 <= x < x1 of the grid and runs the batch engine rules
+(batch.py) on the cars standing there. A car only ever looks at its four neighbours, so
+a shard needs just one extra row of the occupancy counts on each side, its halo, copied
+from the neighbour shard once per tick (the rest of city_objects is static but for the
+lights, which every shard paints from the coordinator's states). Each tick, in two rounds:
+
+1. plan: a shard takes in the cars that crossed into its strip, refreshes its halos and
+   the lights, releases spawns, marks arrivals and picks every car's next cell. Claims on
+   its two boundary rows and halos, the only cells a neighbour's cars can also reach, go to
+   the coordinator, which picks one winner per cell from all shards at once. A car spawned
+   on a boundary row claims its cell there too, ahead of any move.
+2. apply: the shard settles its inner claims itself, moves its cars and hands the cars
+   that left its strip back as migrants. It also reports how many of its cars are in each
+   semaphore's detection range; the coordinator adds these up and evaluates the lights
+   (BatchEngine.update_lights) for the next tick.
+
+So the single-process rules hold across strip borders too: parking exits and target
+lots go to one car, and red cells are only entered next to a green semaphore. Cuts are
+placed between rows with the fewest road cells near an even split, which on Manhattan
+maps puts them inside blocks rather than along streets.
+
+    with ShardedCity(shards=4, cars=5000, spawn=True, city_map=generate_city(400, 400)) as city:
+        city.run(500)
+        records = city.cars()
+
+Each worker builds the whole CityModel (map, spawn queues, and its own route table over
+the full grid) from the same parameters and then drops what it doesn't own, so memory and
+route work grow with the shard count rather than shrinking with the strip. The
+tie-break priorities come from one random stream per shard, so runs are reproducible for
+a given seed and shard count but differ from the single-process batch engine. Like
+BatchEngine.run, the Car and SemaphoreAgent objects are not updated.
+"""
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from Final import CityModel, CAR_RECORD, SPAWN_ROAD_SHARE
+from batch import ARRIVED, MOVING, first_claims
+from city_map import default_map
+from events import NullSink
+
+MIGRANT = np.dtype([("car", np.int64), ("x", np.int64), ("y", np.int64), ("last_x", np.int64),
+                    ("last_y", np.int64), ("target_x", np.int64), ("target_y", np.int64), ("direction", np.int8),
+                    ("departure_step", np.int64)])
+
+
+def strip_bounds(city_map, shards):
+    """[(x0, x1), ...] row ranges of the shards, cut where the fewest road cells meet."""
+    width = city_map.width
+    if not 1 <= shards <= width:
+        raise ValueError(f"Can't split {width} rows into {shards} shards.")
+    road = (city_map.lanes != 0).sum(axis=1)
+    # Cost of a cut just before row r: road cells on both sides of it
+    cost = np.full(width + 1, np.inf)
+    cost[1:width] = road[:-1] + road[1:]
+    cuts = [0]
+    for i in range(1, shards):
+        ideal = round(i * width / shards)
+        slack = max(1, width // (4 * shards))
+        low, high = max(cuts[-1] + 1, ideal - slack), min(width - (shards - i), ideal + slack)
+        candidates = np.arange(low, max(low, high) + 1)
+        cuts.append(int(candidates[np.argmin(cost[candidates])]))
+    cuts.append(width)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+class ShardWorker:
+    """One strip of the city, with a full CityModel whose batch engine only keeps the strip's cars."""
+
+    def __init__(self, shard, bounds, params):
+        self.shard = shard
+        self.x0, self.x1 = bounds
+        self.model = CityModel(**params)
+        engine = self.engine = self.model.batch
+        self.occupancy = engine.occupancy
+        seed = params.get("seed")
+        engine.rng = np.random.default_rng(None if seed is None else [seed, shard])
+
+        foreign = engine.alive & ~self.owns(engine.x)
+        engine.alive[foreign] = False
+        engine.alive_count = int(engine.alive.sum())
+        engine.arrived_count = int((engine.alive & (engine.state == ARRIVED)).sum())
+        foreign = ~self.owns(engine.spawn_x)
+        engine.pending -= int((engine.spawn_end - engine.spawn_head)[foreign].sum())
+        engine.spawn_head[foreign] = engine.spawn_end[foreign]
+        self.model.pending_spawns = engine.pending
+        # The strip's share of the spawn cap, so the shards together keep to the single-process one
+        road = np.count_nonzero(self.model.lane_directions[self.x0:self.x1])
+        self.model.spawn_capacity = max(1, int(road * SPAWN_ROAD_SHARE))
+        self.planned = None
+
+
+    def owns(self, x):
+        return (x >= self.x0) & (x < self.x1)
+
+
+    def plan(self, step, lights, top, bottom, migrants):
+        """First round of a tick; returns the boundary claims, spawns on the border rows last, as (flat cells, priorities)."""
+        engine = self.engine
+        self.model.steps = step
+        self.receive(migrants)
+        if top is not None:
+            self.occupancy[self.x0 - 1] = top
+        if bottom is not None:
+            self.occupancy[self.x1] = bottom
+        engine.light[:] = lights
+        engine.paint_lights()
+        spawned = engine.spawn_cars() if engine.pending else np.zeros(0, dtype=np.int64)
+        # A car spawned on a border row isn't in the neighbour's halo yet: it claims its cell
+        # ahead of every move (priorities are in [0, 1))
+        spawned_x = spawned // engine.height
+        spawned = spawned[((spawned_x == self.x0) | (spawned_x == self.x1 - 1)) & (engine.lanes.flat[spawned] != 0)]
+
+        active, at_target = engine.arrive_cars()
+        plan = engine.plan_moves(np.flatnonzero(active & ~at_target))
+        priority = engine.rng.random(plan.idx.size)
+        boundary = plan.claims & ((plan.dest_x <= self.x0) | (plan.dest_x >= self.x1 - 1))
+        self.planned = plan, priority, boundary
+        return (np.concatenate([plan.dest[boundary], spawned]),
+                np.concatenate([priority[boundary], np.full(spawned.size, -1.0)]))
+
+
+    def apply(self, won):
+        """Second round: move the cars, given which boundary claims won; returns the tick report."""
+        engine = self.engine
+        plan, priority, boundary = self.planned
+        self.planned = None
+        winner = first_claims(plan.dest, plan.claims & ~boundary, priority)
+        winner[boundary] = won[:np.count_nonzero(boundary)]
+        engine.apply_moves(plan, winner)
+
+        leaving = np.flatnonzero(engine.alive & ~self.owns(engine.x))
+        migrants = np.zeros(leaving.size, dtype=MIGRANT)
+        migrants["car"] = leaving
+        for field in MIGRANT.names[1:]:
+            migrants[field] = getattr(engine, field)[leaving]
+        engine.alive[leaving] = False
+        engine.alive_count -= leaving.size
+
+        totals = (engine.alive_count, engine.arrived_count, engine.pending)
+        occupancy = self.occupancy
+        return engine.presence_counts(), occupancy[self.x0].copy(), occupancy[self.x1 - 1].copy(), migrants, totals
+
+
+    def receive(self, migrants):
+        engine = self.engine
+        cars = migrants["car"]
+        for field in MIGRANT.names[1:]:
+            getattr(engine, field)[cars] = migrants[field]
+        engine.state[cars] = MOVING
+        engine.exited[cars] = True
+        engine.arrival_step[cars] = -1
+        engine.alive[cars] = True
+        engine.alive_count += cars.size
+        if engine.route_grids is not None:
+            engine.route_slot[cars] = -1
+        np.add.at(self.occupancy, (migrants["x"], migrants["y"]), 1)
+
+
+    def cars(self):
+        records = np.zeros(self.engine.alive_count, dtype=CAR_RECORD)
+        self.engine.write_car_records(records)
+        return records
+
+
+def serve(connection, shard, bounds, params):
+    """Worker process loop: run (method, args) requests on a ShardWorker until None arrives."""
+    worker = ShardWorker(shard, bounds, params)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        method, args = request
+        try:
+            connection.send((True, getattr(worker, method)(*args)))
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+    connection.close()
+
+
+class ShardedCity:
+    """Coordinator of the shard workers; takes the CityModel parameters (the engine is always batch).
+
+    processes=False keeps the workers in this process, which is slower but easy to debug.
+    """
+
+    def __init__(self, shards=2, processes=True, **params):
+        params["engine"] = "batch"
+        params["events"] = NullSink()
+        params["city_map"] = params.get("city_map") or default_map()
+        self.bounds = strip_bounds(params["city_map"], shards)
+        self.owner = np.repeat(np.arange(shards), [x1 - x0 for x0, x1 in self.bounds])
+        # Evaluates the semaphores from the presence counts of all shards
+        self.lights = CityModel(**dict(params, routing=False)).batch
+
+        self.connections = self.processes = self.workers = None
+        if processes:
+            context = multiprocessing.get_context("spawn")
+            self.connections, self.processes = [], []
+            for shard, bounds in enumerate(self.bounds):
+                parent, child = context.Pipe()
+                process = context.Process(target=serve, args=(child, shard, bounds, params), daemon=True)
+                process.start()
+                child.close()
+                self.connections.append(parent)
+                self.processes.append(process)
+        else:
+            self.workers = [ShardWorker(shard, bounds, params) for shard, bounds in enumerate(self.bounds)]
+
+        self.steps = 0
+        self.running = True
+        self.halos = [(None, None)] * shards
+        self.migrants = [np.zeros(0, dtype=MIGRANT)] * shards
+
+
+    def call(self, method, arguments):
+        """Run method on every shard with its own arguments, in parallel; returns the results in shard order."""
+        if self.workers is not None:
+            return [getattr(worker, method)(*args) for worker, args in zip(self.workers, arguments)]
+        for connection, args in zip(self.connections, arguments):
+            connection.send((method, args))
+        results = []
+        for shard, connection in enumerate(self.connections):
+            ok, result = connection.recv()
+            if not ok:
+                raise RuntimeError(f"Shard {shard} failed in {method}:\n{result}")
+            results.append(result)
+        return results
+
+
+    def step(self):
+        if not self.running:
+            return
+        self.steps += 1
+        shards = len(self.bounds)
+        claims = self.call("plan", [(self.steps, self.lights.light, *self.halos[shard], self.migrants[shard])
+                                    for shard in range(shards)])
+
+        cells = np.concatenate([cell for cell, _ in claims])
+        won = first_claims(cells, np.ones(cells.size, dtype=bool), np.concatenate([priority for _, priority in claims]))
+        reports = self.call("apply", [(part,) for part in np.split(won, np.cumsum([cell.size for cell, _ in claims])[:-1])])
+
+        self.lights.update_lights(counts=sum(report[0] for report in reports))
+        migrants = np.concatenate([report[3] for report in reports])
+        owners = self.owner[migrants["x"]]
+        self.migrants = [migrants[owners == shard] for shard in range(shards)]
+        # A shard's halo is its neighbour's edge row, plus the cars about to move in there
+        edges = []
+        for shard, (x0, x1) in enumerate(self.bounds):
+            top, bottom = reports[shard][1], reports[shard][2]
+            arriving = self.migrants[shard]
+            np.add.at(top, arriving["y"][arriving["x"] == x0], 1)
+            np.add.at(bottom, arriving["y"][arriving["x"] == x1 - 1], 1)
+            edges.append((top, bottom))
+        self.halos = [(edges[shard - 1][1] if shard > 0 else None, edges[shard + 1][0] if shard < shards - 1 else None)
+                      for shard in range(shards)]
+
+        # Migrants are off every shard until their new owner receives them next tick, and never arrived
+        alive, arrived, pending = np.sum([report[4] for report in reports], axis=0)
+        alive += migrants.size
+        if not pending and arrived == alive:
+            self.running = False
+
+
+    def run(self, steps):
+        for _ in range(steps):
+            if not self.running:
+                break
+            self.step()
+
+
+    def cars(self):
+        """CAR_RECORD rows of every car on the grid, in id order (including the migrants in transit)."""
+        migrants = np.concatenate(self.migrants)
+        moving = np.zeros(migrants.size, dtype=CAR_RECORD)
+        moving["id"] = -(migrants["car"] + 1)
+        moving["x"] = migrants["x"]
+        moving["y"] = migrants["y"]
+        moving["heading"] = migrants["direction"]
+        moving["state"] = MOVING
+        records = np.concatenate(self.call("cars", [()] * len(self.bounds)) + [moving])
+        return records[np.argsort(-records["id"])]
+
+
+    def close(self):
+        if self.connections is None:
+            return
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(None)
+            process.join()
+            connection.close()
+        self.connections = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,154 @@
+"""Live CityModel state in shared memory, readable by other local processes without copies.
+
+model.share_state(name) creates a multiprocessing.shared_memory segment and the model
+republishes into it at the end of every step(). The segment holds:
+
+    control   sequence u64, magic "CSHM", version u32, width u32, height u32,
+              snapshot capacity u32 (padded to CONTROL_BYTES)
+    layer     city_objects as int64, width x height, row-major (x, then y)
+    snapshot  the CityModel.snapshot_buffer() layout: header, semaphores, car records
+
+The sequence counter is a seqlock: the publisher makes it odd before writing and even
+again afterwards. A reader notes an even value, reads, and retries if the value changed
+in between, so it never keeps a half-written tick:
+
+    reader = StateReader("city")
+    while True:
+        sequence = reader.begin()
+        red_cells = int((reader.layer == 19).sum())   # zero-copy view
+        if not reader.retry(sequence):
+            break
+
+read() does the same loop and returns copies. There is one publisher per segment; the
+model's process owns the segment and unlinks it in StatePublisher.close().
+"""
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from Final import parse_snapshot
+
+SHARED_MAGIC = b"CSHM"
+SHARED_VERSION = 1
+CONTROL = np.dtype([("sequence", "<u8"), ("magic", "S4"), ("version", "<u4"), ("width", "<u4"), ("height", "<u4"),
+                    ("snapshot_capacity", "<u4")])
+# The layer starts on a cache line
+CONTROL_BYTES = 64
+
+# Segments published by this process; their resource tracker entry belongs to the publisher
+_published = set()
+
+SharedSnapshot = namedtuple("SharedSnapshot", ["tick", "layer", "semaphores", "cars"])
+
+
+class SharedSegment:
+    """Numpy views over the control block, layer and snapshot of a segment."""
+
+    def __init__(self, memory, width, height, snapshot_capacity):
+        self.memory = memory
+        buffer = np.ndarray(memory.size, dtype=np.uint8, buffer=memory.buf)
+        self.control = buffer[:CONTROL.itemsize].view(CONTROL)[0]
+        layer_end = CONTROL_BYTES + width * height * 8
+        self.layer = buffer[CONTROL_BYTES:layer_end].view(np.int64).reshape(width, height)
+        self.snapshot = buffer[layer_end:layer_end + snapshot_capacity]
+
+
+    def snapshot_views(self):
+        """(tick, semaphore records, car records) as views into the segment."""
+        return parse_snapshot(self.snapshot)
+
+
+class StatePublisher(SharedSegment):
+    """Writes a model's state into a new shared memory segment (name=None picks a random name)."""
+
+    def __init__(self, model, name=None):
+        width, height = model.grid.width, model.grid.height
+        capacity = model.snapshot_capacity()
+        memory = shared_memory.SharedMemory(name=name, create=True, size=CONTROL_BYTES + width * height * 8 + capacity)
+        super().__init__(memory, width, height, capacity)
+        self.model = model
+        self.source = model.grid.properties["city_objects"].data
+        _published.add(memory.name)
+        control = self.control
+        control["magic"] = SHARED_MAGIC
+        control["version"] = SHARED_VERSION
+        control["width"] = width
+        control["height"] = height
+        control["snapshot_capacity"] = capacity
+        self.publish()
+
+
+    @property
+    def name(self):
+        return self.memory.name
+
+
+    def publish(self):
+        control = self.control
+        control["sequence"] += 1
+        self.layer[:] = self.source
+        self.model.snapshot_buffer(self.snapshot)
+        control["sequence"] += 1
+
+
+    def close(self):
+        """Release and unlink the segment; readers keep their mapping until they close it."""
+        if self.model.publisher is self:
+            self.model.publisher = None
+        del self.control, self.layer, self.snapshot
+        _published.discard(self.memory.name)
+        self.memory.close()
+        self.memory.unlink()
+
+
+class StateReader(SharedSegment):
+    """Attaches to the segment of a StatePublisher by name."""
+
+    def __init__(self, name):
+        if sys.version_info >= (3, 13):
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            memory = shared_memory.SharedMemory(name=name)
+            # Before 3.13 attaching registers the segment too, and the tracker would unlink it when we exit
+            if memory.name not in _published:
+                resource_tracker.unregister(memory._name, "shared_memory")
+        control = np.ndarray(1, dtype=CONTROL, buffer=memory.buf)[0]
+        valid = control["magic"] == SHARED_MAGIC and control["version"] == SHARED_VERSION
+        shape = int(control["width"]), int(control["height"]), int(control["snapshot_capacity"])
+        del control
+        if not valid:
+            memory.close()
+            raise ValueError(f"Shared memory {name!r} doesn't hold a version {SHARED_VERSION} city state.")
+        super().__init__(memory, *shape)
+
+
+    def begin(self):
+        """Wait until no tick is being written; returns the sequence to pass to retry()."""
+        while True:
+            sequence = int(self.control["sequence"])
+            if not sequence & 1:
+                return sequence
+            time.sleep(0)
+
+
+    def retry(self, sequence):
+        """True if a tick was published since begin() returned sequence, so the reads may be torn."""
+        return int(self.control["sequence"]) != sequence
+
+
+    def read(self):
+        """Consistent copy of the latest tick."""
+        while True:
+            sequence = self.begin()
+            tick, semaphores, cars = self.snapshot_views()
+            snapshot = SharedSnapshot(tick, self.layer.copy(), semaphores.copy(), cars.copy())
+            if not self.retry(sequence):
+                return snapshot
+
+
+    def close(self):
+        del self.control, self.layer, self.snapshot
+        self.memory.close()
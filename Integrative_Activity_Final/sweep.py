@@ -0,0 +1,135 @@
+"""Parameter sweeps over CityModel, fanned out over a process pool.
+
+Every combination of seed, car count, semaphore policy and (for the fixed policy) green
+and red durations is one run. A run goes until every car has arrived or max_steps ticks
+have passed, with events discarded (NullSink), and yields one row of metrics. The rows
+are saved as one column per field in a .npz file:
+
+    python sweep.py --seeds 0-19 --cars 5,10,17 --policy actuated,fixed --green 3,5 --red 3,5 -o sweep.npz
+
+    results = np.load("sweep.npz")
+    results["mean_trip_time"][results["policy"] == "fixed"]
+"""
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Final import CityModel
+from events import NullSink
+
+# Columns of the results file; -1 marks a duration the policy doesn't use or a run that didn't finish
+RESULT_DTYPE = np.dtype([
+    ("seed", np.int64),
+    ("cars", np.int64),
+    ("policy", "U8"),
+    ("green_duration", np.int64),
+    ("red_duration", np.int64),
+    ("spawn", bool),
+    ("engine", "U8"),
+    ("max_steps", np.int64),
+    ("steps", np.int64),                # ticks run
+    ("steps_to_all_arrived", np.int64),  # -1 when max_steps ran out first
+    ("arrived", np.int64),
+    ("mean_trip_time", np.float64),     # ticks from entering the grid to arriving, NaN if nobody arrived
+    ("throughput", np.float64),         # arrivals per tick
+    ("wall_time", np.float64),          # seconds
+])
+
+
+def expand_grid(seeds, cars, policies=("actuated",), green_durations=(5,), red_durations=(5,),
+                spawn=False, engine="agents", max_steps=1000):
+    """One parameter dict per run. Actuated runs ignore the durations, so they aren't multiplied by them."""
+    configs = []
+    for seed, car_count, policy in itertools.product(seeds, cars, policies):
+        if policy == "fixed":
+            durations = itertools.product(green_durations, red_durations)
+        else:
+            durations = [(-1, -1)]
+        for green, red in durations:
+            configs.append({"seed": seed, "cars": car_count, "policy": policy, "green_duration": green,
+                            "red_duration": red, "spawn": spawn, "engine": engine, "max_steps": max_steps})
+    return configs
+
+
+def run_one(config):
+    """Run a single configuration and return its row as a tuple in RESULT_DTYPE order."""
+    params = {"cars": config["cars"], "seed": config["seed"], "spawn": config["spawn"], "engine": config["engine"],
+              "semaphore_policy": config["policy"], "events": NullSink()}
+    if config["policy"] == "fixed":
+        params["green_duration"] = config["green_duration"]
+        params["red_duration"] = config["red_duration"]
+
+    started = time.perf_counter()
+    model = CityModel(**params)
+    if model.batch is not None:
+        # No mesa step wrapper per tick; trip_times() syncs the agents once at the end
+        model.batch.run(config["max_steps"])
+    else:
+        while model.running and model.steps < config["max_steps"]:
+            model.step()
+    wall_time = time.perf_counter() - started
+
+    trips = model.trip_times()
+    steps = model.steps
+    return (config["seed"], config["cars"], config["policy"], config["green_duration"], config["red_duration"],
+            config["spawn"], config["engine"], config["max_steps"], steps, -1 if model.running else steps,
+            trips.size, trips.mean() if trips.size else np.nan, trips.size / steps if steps else 0.0, wall_time)
+
+
+def run_sweep(configs, workers=None, chunksize=1):
+    """Run every configuration on a pool of worker processes; returns a RESULT_DTYPE array in config order."""
+    if workers == 1:
+        rows = [run_one(config) for config in configs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(run_one, configs, chunksize=chunksize))
+    return np.array(rows, dtype=RESULT_DTYPE)
+
+
+def save_results(path, results):
+    """Write one array per column."""
+    np.savez_compressed(path, **{name: results[name] for name in RESULT_DTYPE.names})
+
+
+def parse_list(text, cast=int):
+    """"1,2,5-8" -> [1, 2, 5, 6, 7, 8] (ranges inclusive, only for integers)."""
+    values = []
+    for part in text.split(","):
+        if cast is int and "-" in part[1:]:
+            first, last = part.split("-", 1)
+            values.extend(range(int(first), int(last) + 1))
+        else:
+            values.append(cast(part))
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a CityModel parameter sweep on a process pool.")
+    parser.add_argument("--seeds", default="0-9", help="seeds, e.g. 0-19 or 1,4,9")
+    parser.add_argument("--cars", default="17", help="car counts, e.g. 5,10,17")
+    parser.add_argument("--policy", default="actuated,fixed", help="semaphore policies: actuated, fixed")
+    parser.add_argument("--green", default="5", help="green durations (fixed policy)")
+    parser.add_argument("--red", default="5", help="red durations (fixed policy)")
+    parser.add_argument("--spawn", action="store_true", help="use spawn queues (needed for more than 17 cars)")
+    parser.add_argument("--engine", default="agents", choices=("agents", "batch"))
+    parser.add_argument("--max-steps", type=int, default=1000, help="step budget per run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("-o", "--output", default="sweep.npz")
+    args = parser.parse_args()
+
+    configs = expand_grid(parse_list(args.seeds), parse_list(args.cars), parse_list(args.policy, str),
+                          parse_list(args.green), parse_list(args.red), args.spawn, args.engine, args.max_steps)
+    started = time.perf_counter()
+    results = run_sweep(configs, workers=args.workers, chunksize=max(1, len(configs) // (4 * (args.workers or 1))))
+    save_results(args.output, results)
+
+    finished = results["steps_to_all_arrived"] >= 0
+    print(f"{len(results)} runs in {time.perf_counter() - started:.1f}s, {finished.sum()} finished, saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from Final import CityModel, LIGHT_CODES, parse_snapshot
+
+
+def finish(model, limit=2000):
+    for _ in range(limit):
+        if not model.running:
+            break
+        model.step()
+    model.sync_agents()
+    return model
+
+
+@pytest.mark.parametrize("params", [{"cars": 17}, {"cars": 200, "spawn": True}])
+def test_engines_agree_on_counts_and_arrivals(params):
+    agents = finish(CityModel(seed=3, **params))
+    batch = finish(CityModel(seed=3, engine="batch", **params))
+    for model in (agents, batch):
+        assert not model.running
+        assert model.state_counts == {"idle": 0, "moving": 0, "arrived": params["cars"]}
+        assert all(car.pos == car.target_parking for car in model.cars_list)
+    # Same seed, same fleet: both engines start from the same cars and send them to the same lots
+    assert sorted((car.unique_id, car.start_parking, car.target_parking) for car in agents.cars_list) == \
+        sorted((car.unique_id, car.start_parking, car.target_parking) for car in batch.cars_list)
+    assert agents.trip_times().size == batch.trip_times().size == params["cars"]
+
+
+@pytest.mark.parametrize("engine", ["agents", "batch"])
+def test_one_car_per_road_cell(engine):
+    # Far more cars than the 24x24 map has road cells: spawns wait for room instead of piling up
+    model = CityModel(cars=1500, seed=1, spawn=True, engine=engine)
+    road = model.lane_directions != 0
+    worst = 0
+    for _ in range(4000):
+        if not model.running:
+            break
+        model.step()
+        worst = max(worst, int(model.occupancy[road].max()))
+    assert worst == 1
+    assert not model.running
+
+
+def test_agents_sync_only_when_read():
+    model = CityModel(cars=17, seed=3, engine="batch")
+    car = model.get_car(1)
+    start = car.pos
+    for _ in range(10):
+        model.step()
+    engine = model.batch
+    # Stepping leaves the agents where they were; the snapshot comes from the arrays
+    assert car.pos == start and engine.dirty.any()
+    _, semaphores, cars = parse_snapshot(model.snapshot_buffer())
+    assert model.get_car(1) is car
+    assert car.pos == (engine.x[0], engine.y[0]) != start
+    assert not engine.dirty.any()
+    assert sorted(zip(cars["id"].tolist(), cars["x"].tolist(), cars["y"].tolist())) == \
+        sorted((c.unique_id, *c.pos) for c in model.cars_list)
+    assert semaphores["light"].tolist() == [LIGHT_CODES[model.semaphores[semaphore_id].light_state]
+                                            for semaphore_id in semaphores["id"].tolist()]
+
+
+def test_batch_runs_are_reproducible():
+    runs = [finish(CityModel(cars=17, seed=5, engine="batch")) for _ in range(2)]
+    assert runs[0].steps == runs[1].steps
+    assert np.array_equal(runs[0].trip_times(), runs[1].trip_times())
+
+
+@pytest.mark.parametrize("engine", ["agents", "batch"])
+@pytest.mark.parametrize("car_id", [0, -1, 18])
+def test_set_car_target_rejects_unknown_numbers(engine, car_id):
+    model = CityModel(cars=17, seed=1, engine=engine)
+    targets = [car.target_parking for car in model.cars_list]
+    with pytest.raises(ValueError):
+        model.set_car_target(car_id, model.parking_lots[0])
+    assert [car.target_parking for car in model.cars_list] == targets
@@ -0,0 +1,44 @@
+import pytest
+
+from Final import CityModel
+from checkpoint import load_checkpoint, save_checkpoint
+from city_map import CityMap, default_map
+
+
+def renumbered_map(offset):
+    """The default map with its semaphore ids shifted by offset, so they differ from mesa's unique_ids."""
+    city_map = default_map()
+    semaphores = {semaphore_id + offset: spec._replace(paired=spec.paired + offset)
+                  for semaphore_id, spec in city_map.semaphores.items()}
+    return CityMap(city_map.objects, city_map.lanes, city_map.parking_lots, semaphores, name="renumbered")
+
+
+def trace(model, steps):
+    states = []
+    for _ in range(steps):
+        model.step()
+        model.sync_agents()
+        states.append((model.steps, sorted((car.unique_id, car.pos, car.state) for car in model.cars_list),
+                       sorted((semaphore_id, semaphore.light_state, semaphore.step_counter)
+                              for semaphore_id, semaphore in model.semaphores.items())))
+    return states
+
+
+def dirty_semaphores(model):
+    model.sync_agents()
+    return model.dirty_semaphores
+
+
+@pytest.mark.parametrize("engine", ["agents", "batch"])
+def test_round_trip_keeps_map_semaphore_ids(tmp_path, engine):
+    model = CityModel(cars=200, seed=4, spawn=True, engine=engine, city_map=renumbered_map(10))
+    assert min(model.semaphores) == 11
+    # Pairs with cars on both sides stay due for evaluation across ticks
+    while not dirty_semaphores(model):
+        model.step()
+    path = tmp_path / "city.npz"
+    save_checkpoint(model, path)
+    restored = load_checkpoint(path)
+    assert sorted(restored.semaphores) == sorted(model.semaphores)
+    assert {s.positions[0] for s in restored.dirty_semaphores} == {s.positions[0] for s in model.dirty_semaphores}
+    assert trace(restored, 40) == trace(model, 40)
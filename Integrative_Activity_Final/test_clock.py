@@ -0,0 +1,43 @@
+from Final import CityModel
+from clock import SimulationClock
+
+
+def test_subscribing_after_the_clock_ends_gets_a_closed_slot():
+    clock = SimulationClock(CityModel(cars=17, seed=1), tick_rate=10000, snapshot=lambda model: model.steps)
+    clock.start()
+    clock.thread.join(timeout=30)
+    assert not clock.model.running
+    slot = clock.subscribe()
+    assert slot.closed
+    assert slot.get(timeout=1) == clock.snapshot
+    assert slot.get(timeout=1) is None
+    assert slot not in clock.subscribers
+
+
+def test_subscribing_after_stop_gets_a_closed_slot():
+    clock = SimulationClock(CityModel(cars=17, seed=1), tick_rate=1, snapshot=lambda model: model.steps)
+    clock.start()
+    clock.stop()
+    assert clock.subscribe().closed
+
+
+def test_clock_restarts_after_stop():
+    clock = SimulationClock(CityModel(cars=17, seed=1), tick_rate=200, snapshot=lambda model: model.steps)
+    clock.start()
+    clock.stop()
+    steps = clock.model.steps
+    clock.start()
+    slot = clock.subscribe()
+    assert not slot.closed
+    assert slot.get(timeout=1) is not None
+    assert slot.get(timeout=5) > steps
+    clock.stop()
+    assert slot.closed
+
+
+def test_stream_rows_carry_car_numbers():
+    from Flaskapp import positions_snapshot
+    model = CityModel(cars=5, seed=1)
+    snapshot = positions_snapshot(model)
+    assert snapshot.ids == [-car.unique_id for car in model.cars_list]
+    assert sorted(snapshot.ids) == [1, 2, 3, 4, 5]
@@ -0,0 +1,14 @@
+from Final import Car, CityModel
+
+
+def test_profiling_is_per_model():
+    profiled = CityModel(cars=17, seed=1, profile=True)
+    plain = CityModel(cars=17, seed=1)
+    methods = dict(vars(Car))
+    for _ in range(5):
+        profiled.step()
+        plain.step()
+    # Turning profiling on doesn't patch the agent classes for every other model
+    assert dict(vars(Car)) == methods
+    assert plain.profiler is None
+    assert profiled.profiler.counts["car.move"] > 0
@@ -0,0 +1,49 @@
+import pytest
+
+from Final import CityModel
+from replay import ReplayReader
+
+
+def test_recording_appends_to_an_existing_log(tmp_path):
+    path = tmp_path / "run.replay"
+    model = CityModel(cars=17, seed=1)
+    model.record_replay(path, keyframe_every=4)
+    for _ in range(5):
+        model.step()
+    model.recorder.close()
+    # A record cut short by a crash
+    with open(path, "ab") as log:
+        log.write(b"\x00\x07")
+
+    for _ in range(2):
+        model.step()
+    model.record_replay(path, keyframe_every=4)
+    for _ in range(3):
+        model.step()
+    model.recorder.close()
+
+    reader = ReplayReader(path)
+    assert reader.ticks.tolist() == [0, 1, 2, 3, 4, 5, 7, 8, 9, 10]
+    assert reader.end == path.stat().st_size
+    state = reader.state_at(10)
+    assert sorted(zip(state.cars["id"].tolist(), state.cars["x"].tolist(), state.cars["y"].tolist())) == \
+        sorted((car.unique_id, *car.pos) for car in model.cars_list)
+
+
+def test_appending_checks_the_log(tmp_path):
+    path = tmp_path / "run.replay"
+    model = CityModel(cars=17, seed=1)
+    model.record_replay(path, keyframe_every=4)
+    model.step()
+    model.recorder.close()
+    size = path.stat().st_size
+
+    model.step()
+    with pytest.raises(ValueError):
+        model.record_replay(path, keyframe_every=8)
+    with pytest.raises(ValueError):
+        CityModel(cars=5, seed=1).record_replay(path, keyframe_every=4)
+    # Tick 0 is already in the log
+    with pytest.raises(ValueError):
+        CityModel(cars=17, seed=1).record_replay(path, keyframe_every=4)
+    assert path.stat().st_size == size
@@ -0,0 +1,79 @@
+from collections import deque
+
+import numpy as np
+
+import routing
+from Final import CityModel, NEIGHBOR_OFFSETS, NEIGHBOR_BITS
+from citygen import generate_city
+from routing import HopGrids
+
+
+def reference_distances(model, destination):
+    """Plain queue BFS backwards over the lane graph, cell by cell."""
+    lanes = model.lane_directions
+    width, height = lanes.shape
+    distances = np.full((width, height), -1)
+    distances[destination] = 0
+    queue = deque([destination])
+    while queue:
+        v = queue.popleft()
+        for k, (dx, dy) in enumerate(NEIGHBOR_OFFSETS):
+            u = (v[0] - dx, v[1] - dy)
+            if not (0 <= u[0] < width and 0 <= u[1] < height) or not lanes[u] or distances[u] >= 0:
+                continue
+            # Lots are entered from any side, road cells only along their lanes
+            if v == destination or lanes[v] & NEIGHBOR_BITS[k]:
+                distances[u] = distances[v] + 1
+                queue.append(u)
+    return distances
+
+
+def test_routes_are_shortest():
+    model = CityModel(cars=20, seed=1, city_map=generate_city(40, 40, seed=3))
+    lanes = model.lane_directions
+    for destination in model.parking_lots[:5]:
+        expected = reference_distances(model, destination)
+        hops = model.routes.hop_grid(destination)
+        for cell in zip(*np.nonzero(lanes)):
+            cell = (int(cell[0]), int(cell[1]))
+            assert model.routes.distance(cell, destination) == expected[cell]
+            assert (hops[cell] >= 0) == (expected[cell] > 0)
+
+
+def test_models_on_one_map_share_the_hop_grids():
+    city_map = generate_city(40, 40, seed=3)
+    first = CityModel(cars=20, seed=1, city_map=city_map, engine="batch")
+    second = CityModel(cars=20, seed=2, city_map=city_map)
+    first.step()
+    assert first.routes.current() is second.routes.current()
+    searched = len(first.routes.current().slots)
+    assert searched > 0
+    second.routes.hop_grid(first.cars_list[0].target_parking)
+    assert len(second.routes.current().slots) == searched
+
+
+def test_hop_rows_stay_within_their_memory_cap():
+    city_map = generate_city(300, 300, seed=7)
+    lanes, lots = city_map.lanes, city_map.parking_lots
+    grids = HopGrids(lanes, lots, max_bytes=2 << 20)
+    # Two routable cells per byte: a row is far smaller than the 90000-cell grid
+    assert grids.row_bytes * 2 < lanes.size
+    for destination in lots[:grids.capacity + 40]:
+        grids.lookup([destination])
+    assert grids.rows.nbytes <= 2 << 20
+    assert len(grids.slots) == grids.capacity
+    # The least recently used destinations gave their rows up; asking again searches them anew
+    assert lots[0] not in grids.slots and lots[grids.capacity + 39] in grids.slots
+    assert np.array_equal(grids.grid(lots[0]), HopGrids(lanes, lots).grid(lots[0]))
+
+
+def test_batch_engine_with_fewer_hop_rows_than_targets(monkeypatch):
+    # A size no other test uses, so no HopGrids of these lanes is shared yet
+    city_map = generate_city(36, 36, seed=11)
+    monkeypatch.setattr(routing, "ROUTE_CACHE_BYTES", 4 * HopGrids(city_map.lanes, city_map.parking_lots).row_bytes)
+    model = CityModel(cars=300, seed=1, spawn=True, engine="batch", city_map=city_map)
+    model.batch.run(5000)
+    grids = model.routes.current()
+    assert grids.capacity == 4 and grids.rows.shape[0] == 4
+    assert not model.running
+    assert model.count_cars("arrived") == 300
@@ -0,0 +1,62 @@
+import itertools
+
+import numpy as np
+
+from Final import CityModel, LIGHT_CODES
+
+
+def test_waiting_cars_is_a_snapshot():
+    model = CityModel(cars=17, seed=2)
+    semaphore = next(semaphore for semaphore in model.semaphores.values() if semaphore.range_cells)
+    semaphore.cars_in_range.add(-99)
+    semaphore.manage_light_state()
+    paired = model.semaphores[semaphore.paired_semaphore]
+    assert -99 in semaphore.waiting_cars
+    semaphore.cars_in_range.discard(-99)
+    paired.cars_in_range.add(-98)
+    assert -99 in semaphore.waiting_cars
+    assert -98 not in paired.waiting_cars
+
+
+def test_synced_waiting_cars_are_snapshots():
+    model = CityModel(cars=17, seed=2, engine="batch")
+    for _ in range(5):
+        model.step()
+    model.sync_agents()
+    for semaphore in model.semaphores.values():
+        assert semaphore.waiting_cars == semaphore.cars_in_range
+        assert semaphore.waiting_cars is not semaphore.cars_in_range
+
+
+def test_contested_pair_alternates_green():
+    model = CityModel(cars=17, seed=2)
+    controller = model.semaphore_controllers[0]
+    paired = model.semaphores[controller.paired_semaphore]
+    # Cars that never leave, on both sides of the pair
+    controller.cars_in_range.add(-98)
+    paired.cars_in_range.add(-99)
+    greens = []
+    for _ in range(4 * (controller.green_duration + 1)):
+        model.dirty_semaphores.add(controller)
+        model.update_semaphores()
+        assert controller in model.dirty_semaphores
+        assert {controller.light_state, paired.light_state} == {"green", "red"}
+        greens.append(controller.light_state == "green")
+    # Each side holds green for green_duration + 1 evaluations, then yields
+    runs = [len(list(run)) for _, run in itertools.groupby(greens)]
+    assert len(runs) >= 3 and set(runs[1:-1]) == {controller.green_duration + 1}
+
+
+def test_engines_alternate_contested_pairs_alike():
+    agents = CityModel(cars=17, seed=2)
+    batch = CityModel(cars=17, seed=2, engine="batch").batch
+    counts = np.ones(len(batch.semaphore_ids))
+    for _ in range(20):
+        for controller in agents.semaphore_controllers:
+            agents.semaphores[controller.paired_semaphore].cars_in_range.add(-99)
+            controller.cars_in_range.add(-98)
+            agents.dirty_semaphores.add(controller)
+        agents.update_semaphores()
+        batch.update_lights(counts=counts)
+        lights = [LIGHT_CODES[agents.semaphores[semaphore_id].light_state] for semaphore_id in batch.semaphore_ids]
+        assert lights == batch.light.tolist()
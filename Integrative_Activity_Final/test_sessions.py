@@ -0,0 +1,52 @@
+import pytest
+
+import sessions
+from sessions import SessionManager, estimate_model_bytes
+
+
+def test_memory_cap_is_checked_before_building(monkeypatch):
+    def build(**params):
+        raise AssertionError("model built despite the memory cap")
+
+    monkeypatch.setattr(sessions, "CityModel", build)
+    manager = SessionManager(max_memory=estimate_model_bytes(24, 24, 1000) - 1)
+    with pytest.raises(MemoryError):
+        manager.create(cars=1000)
+    assert manager.sessions == {}
+
+
+def test_estimate_follows_cars_map_and_engine():
+    assert estimate_model_bytes(24, 24, 20) < estimate_model_bytes(24, 24, 40)
+    assert estimate_model_bytes(24, 24, 20) < estimate_model_bytes(48, 48, 20)
+    assert estimate_model_bytes(24, 24, 20, "batch") < estimate_model_bytes(24, 24, 20, "agents")
+
+
+@pytest.fixture
+def client():
+    from Flaskapp import app
+    return app.test_client()
+
+
+@pytest.mark.parametrize("body", [{}, {"cars": "abc"}, {"cars": 0}, {"cars": 5, "spawn": "false"},
+                                  {"cars": True}, {"cars": 5, "engine": 1}, [5]])
+def test_bad_session_params_are_rejected(client, body):
+    assert client.post("/sessions", json=body).status_code == 400
+
+
+def test_step_count_is_validated(client):
+    session_id = client.post("/sessions", json={"cars": 5, "seed": 1, "spawn": False}).get_json()["session_id"]
+    for steps in ("abc", "0", "1000000"):
+        assert client.post(f"/sessions/{session_id}/step?steps={steps}").status_code == 400
+    assert client.post(f"/sessions/{session_id}/step?steps=3").get_json() == {"tick": 3}
+    client.delete(f"/sessions/{session_id}")
+
+
+def test_metrics_report_semaphore_evaluations(client):
+    session_id = client.post("/sessions", json={"cars": 17, "seed": 1}).get_json()["session_id"]
+    client.post(f"/sessions/{session_id}/step?steps=10")
+    report = client.get(f"/sessions/{session_id}/metrics").get_json()
+    assert report["enabled"] is False
+    assert report["semaphore_evaluations"] > 0
+    assert 0 <= report["last_semaphore_evaluations"] <= report["semaphore_evaluations"]
+    assert client.get("/metrics").get_json()["semaphore_evaluations"] >= 0
+    client.delete(f"/sessions/{session_id}")
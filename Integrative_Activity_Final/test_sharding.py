@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from Final import CityModel, CAR_RECORD
+from batch import ARRIVED
+from sharding import ShardedCity
+
+
+@pytest.mark.parametrize("params", [{"cars": 17}, {"cars": 500, "spawn": True}])
+def test_car_count_is_constant_across_a_sharded_run(params):
+    city = ShardedCity(shards=3, processes=False, seed=0, **params)
+    while city.running:
+        city.step()
+        records = city.cars()
+        # Cars still waiting to spawn are the only ones off the grid, migrants in transit included
+        assert len(records) + sum(worker.engine.pending for worker in city.workers) == params["cars"]
+        assert np.unique(records["id"]).size == len(records)
+    assert len(records) == params["cars"]
+    assert (records["state"] == ARRIVED).all()
+
+
+@pytest.mark.parametrize("params", [{"cars": 17}, {"cars": 1500, "spawn": True}])
+def test_sharded_run_keeps_the_single_process_invariants(params):
+    single = CityModel(seed=1, engine="batch", **params)
+    single.batch.run(4000)
+    road = single.lane_directions != 0
+    # Five strips put the entries at (12, 23) and (13, 23) on border rows
+    city = ShardedCity(shards=5, processes=False, seed=1, **params)
+    for _ in range(4000):
+        if not city.running:
+            break
+        city.step()
+        records = city.cars()
+        on_road = records[road[records["x"], records["y"]]]
+        # One car per road cell, across strip borders too
+        assert np.unique(on_road[["x", "y"]]).size == on_road.size
+    assert not single.running and not city.running
+    # Same fleet, same targets: every car ends on the lot the single-process run parks it in
+    expected = np.zeros(params["cars"], dtype=CAR_RECORD)
+    single.batch.write_car_records(expected)
+    expected = expected[np.argsort(-expected["id"])]
+    assert np.array_equal(records[["id", "x", "y", "state"]], expected[["id", "x", "y", "state"]])
@@ -0,0 +1,35 @@
+import pytest
+
+from Final import CityModel
+
+
+@pytest.mark.parametrize("weights", [[1] + [0] * 16, [0] * 17])
+def test_targets_without_another_weighted_lot_are_rejected(weights):
+    # Used to redraw forever: the car starting on the only weighted lot has nowhere else to go
+    with pytest.raises(ValueError):
+        CityModel(cars=5, spawn=True, target_weights=weights)
+
+
+@pytest.mark.parametrize("weights", [[1] * 16, [1] * 18, [1] * 16 + [-1]])
+def test_target_weights_must_match_the_lots(weights):
+    with pytest.raises(ValueError):
+        CityModel(cars=5, spawn=True, target_weights=weights)
+
+
+def test_targets_follow_the_weights_and_skip_the_start():
+    model = CityModel(cars=300, seed=2, spawn=True, target_weights=[0] * 15 + [1, 3])
+    weighted = set(model.parking_lots[15:])
+    queued = [(point, target) for point, queue in model.spawn_queues.items() for _, target in queue]
+    assert all(target in weighted and target != point for point, target in queued)
+    # The start lot's share is left out of the draw, so a car on one weighted lot always picks the other
+    assert {target for point, target in queued if point == model.parking_lots[16]} == {model.parking_lots[15]}
+
+
+@pytest.mark.parametrize("engine", ["agents", "batch"])
+def test_parked_cars_free_their_lot_in_spawn_mode(engine):
+    model = CityModel(cars=200, seed=3, spawn=True, engine=engine)
+    while model.running and model.steps < 2000:
+        model.step()
+    assert not model.running
+    # Lots work as garages: more cars than lots have parked, and none of them blocks its lot
+    assert all(model.occupancy[lot] == 0 for lot in model.parking_lots)